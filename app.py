@@ -1,19 +1,30 @@
 
-from shiny import App, reactive, render, ui
+import os
+import asyncio
 
-from shinywidgets import render_plotly
+from shiny import App, reactive, render, ui
 
 import definitions.layout_styles as styles
 from definitions.backend_calculations import detect_models, compute_overlap
-from definitions.backend_dynamic_plots import plot_overlap
+from definitions.backend_dynamic_plots import plot_overlap, plot_conjunction
+from definitions.conjunction import compute_conjunction, selection_label
+from definitions.figure_cache import cached_figures, map_hash, brain_view, brain_view_dependencies, figure_routes
+from definitions.instrumentation import mount_metrics
+from definitions.lazy_imports import prewarm
+from definitions.model_search import search_models
+from definitions.result_watcher import watch_results, catalog_maps, catalog_updates
+from definitions.session_resources import hold, session_routes
+from definitions.shared_store import start_loader
+from definitions.spin_test import spin_overlap_test, N_PERMUTATIONS
 
-from definitions.ui_functions import single_result_ui, update_single_result, overlap_page
+from definitions.ui_functions import single_result_ui, update_single_result, overlap_page, conjunction_page, search_page
 
 start_folder = './results'
 
 # ======================================================================================================================
 
 app_ui = ui.page_fillable(
+    brain_view_dependencies(),
     ui.page_navbar(
         ui.nav_spacer(),
         ui.nav_panel('Welcome to BrainMApp',
@@ -49,6 +60,21 @@ app_ui = ui.page_fillable(
                      ' ',  # spacer
                      value='tab3'
                      ),
+        ui.nav_panel('Conjunction',
+                     ui.markdown('</br>Select any number of maps to see where (and in how many of them) clusters'
+                                 ' were found, and which combinations of maps share the most vertices.</br>'),
+                     conjunction_page,
+                     ' ',  # spacer
+                     value='tab4'
+                     ),
+        ui.nav_panel('Search',
+                     ui.markdown('</br>Find all the maps with clusters in a region: the clusters of a map (e.g. '
+                                 '`SCZ/SCZ`, `SCZ/SCZ/area` or one cluster: `SCZ/SCZ/area:lh1`) or vertices of the left'
+                                 ' / right hemisphere (e.g. `lh:1200-1500,1731 rh:52`).</br>'),
+                     search_page,
+                     ' ',  # spacer
+                     value='tab5'
+                     ),
         title="BrainMApp: visualize your verywise output",
         selected='tab1',
         position='fixed-top',
@@ -92,8 +118,8 @@ def server(input, output, session):
         text = {}
         legend = {}
         for key in [1, 2, 3]:
-            text[key] = f'**{ovlp_info[key][1]}%** ({ovlp_info[key][0]} vertices)' if key in ovlp_info.keys() else \
-                '**0%** (0 vertices)'
+            text[key] = f'**{ovlp_info[key][1]}%** ({ovlp_info[key][0]} fsaverage vertices)' \
+                if key in ovlp_info.keys() else '**0%** (0 fsaverage vertices)'
             color = styles.OVLP_COLORS[key-1]
             legend[key] = f'<span style = "background-color: {color}; color: {color}"> oo</span>'
 
@@ -101,24 +127,165 @@ def server(input, output, session):
                            f'{text[1]} was unique to {legend[1]}  **{model1()}** (<ins>{measure1()}</ins>)</br>'
                            f'{text[2]} was unique to {legend[2]}  **{model2()}** (<ins>{measure2()}</ins>)')
 
+    spin_result = reactive.Value(None)
+    spin_tasks = set()
+
+    @reactive.Effect
+    @reactive.event(input.overlap_spin_button)
+    def _start_spin_test():
+        # Rotations are only pre-computed down to fsaverage6. The test runs in a thread, outside of the reactive
+        # flush (which is shared by all sessions): building the rotations of a resolution the first time takes a while
+        resol = 'fsaverage6' if input.overlap_select_resolution() == 'fsaverage' else input.overlap_select_resolution()
+        selections = dict(resdir=input.results_folder(),
+                          selection1=(group1(), model1(), measure1()),
+                          selection2=(group2(), model2(), measure2()))
+
+        progress = ui.Progress(min=0, max=1)
+        progress.set(0, message=f"Rotating maps ({N_PERMUTATIONS} permutations)...")
+
+        async def run():
+            try:
+                spin = await asyncio.to_thread(spin_overlap_test, **selections, resol=resol)
+            except Exception as e:  # shown by the output
+                spin = e
+            finally:
+                progress.close()
+            async with reactive.lock():
+                spin_result.set((resol, selections, spin))
+                await reactive.flush()
+
+        task = asyncio.create_task(run())
+        spin_tasks.add(task)
+        task.add_done_callback(spin_tasks.discard)
+
+    @render.text
+    def overlap_spin_info():
+        if spin_result() is None:
+            return None
+        resol, selections, spin = spin_result()
+        if isinstance(spin, Exception):
+            raise spin
+
+        # The test counts vertices of the (downsampled) maps at its resolution, not fsaverage vertices as above
+        return ui.markdown(f'Spin test ({resol}): the observed overlap of **{spin["observed"]}** {resol} vertices '
+                           f'compares to **{spin["null"].mean():.0f}** vertices on average across {spin["n_perm"]} '
+                           f'random rotations of **{selections["selection1"][1]}**, '
+                           f'*p*<sub>spin</sub> = **{spin["p_spin"]:.3f}**')
+
+    def overlap_figures(resdir, selections, surf, resol):
+        ovlp_maps = compute_overlap(resdir=resdir, **selections, resol=resol)[1]
+
+        return cached_figures(('overlap', map_hash(ovlp_maps['left'], ovlp_maps['right']), resol, surf),
+                              lambda: plot_overlap(resdir=resdir, **selections, surf=surf, resol=resol),
+                              resol=resol)
+
     @reactive.Calc
     def overlap_brain3D():
-        return plot_overlap(resdir=input.results_folder(),
-                            group1=group1(), model1=model1(), measure1=measure1(),
-                            group2=group2(), model2=model2(), measure2=measure2(),
-                            surf=input.overlap_select_surface(),
-                            resol=input.overlap_select_resolution())
+        selections = dict(group1=group1(), model1=model1(), measure1=measure1(),
+                          group2=group2(), model2=model2(), measure2=measure2())
+        resdir, surf, resol = input.results_folder(), input.overlap_select_surface(), input.overlap_select_resolution()
+        return hold(session, 'overlap', lambda: overlap_figures(resdir, selections, surf, resol))
 
-    @render_plotly
+    @render.ui
     def overlap_brain_left():
-        brain = overlap_brain3D()
-        return brain['left']
+        return brain_view(overlap_brain3D().value()['left'])
 
-    @render_plotly
+    @render.ui
     def overlap_brain_right():
-        brain = overlap_brain3D()
-        return brain['right']
+        return brain_view(overlap_brain3D().value()['right'])
+
+    # TAB 4: CONJUNCTION
+    @reactive.Effect
+    @reactive.event(input.go_button, catalog_updates(), ignore_init=True)
+    def _update_conjunction_choices():
+        if not os.path.isdir(input.results_folder()):
+            return
+        choices = {}
+        for group, model, measure in catalog_maps(input.results_folder()):
+            choices.setdefault(group, {})[f'{group}/{model}/{measure}'] = selection_label((group, model, measure))
+        with reactive.isolate():
+            selected = [s for s in input.conj_select_models() if any(s in c for c in choices.values())]
+        ui.update_selectize('conj_select_models', choices=choices, selected=selected)
+
+    @reactive.Calc
+    @reactive.event(input.conj_go_button)
+    def conjunction():
+        selections = [tuple(s.split('/')) for s in input.conj_select_models()]
+        resdir, resol = input.results_folder(), input.conj_select_resolution()
+        return hold(session, 'conjunction',
+                    lambda: compute_conjunction(resdir, selections, resol=resol) if selections else None)
+
+    @render.text
+    def conj_info():
+        conj = conjunction().value()
+        if conj is None:
+            return ui.markdown('Select at least one map and hit **GO**.')
+
+        n_any = sum(int(conj['any'][hemi].sum()) for hemi in ['left', 'right'])
+        n_all = sum(int(conj['all'][hemi].sum()) for hemi in ['left', 'right'])
+        return ui.markdown(f'**{n_any}** vertices are significant in at least one of the {conj["n"]} maps selected, '
+                           f'**{n_all}** in all of them.')
+
+    @reactive.Calc
+    def conjunction_brain3D():
+        conj = conjunction().value()
+        if conj is None:
+            return {'left': None, 'right': None}
+        with reactive.isolate():
+            display, surf = input.conj_select_display(), input.conj_select_surface()
+            resol = input.conj_select_resolution()
+            return cached_figures(('conjunction', map_hash(conj[display]['left'], conj[display]['right']),
+                                   resol, surf, display, conj['n']),
+                                  lambda: plot_conjunction(conj, display=display, surf=surf, resol=resol),
+                                  resol=resol)
+
+    @render.ui
+    def conj_brain_left():
+        return brain_view(conjunction_brain3D()['left'])
+
+    @render.ui
+    def conj_brain_right():
+        return brain_view(conjunction_brain3D()['right'])
+
+    @render.table
+    def conj_combinations():
+        conj = conjunction().value()
+        if conj is None:
+            return None
+        table = conj['combinations'].copy()
+        for col in table.columns[2:]:
+            table[col] = table[col].map({True: '●', False: ''})
+        return table.rename(columns={'vertices': 'Vertices', 'n_models': 'Maps'})
+
+    # TAB 5: SEARCH
+    @reactive.Calc
+    @reactive.event(input.search_button)
+    def search():
+        try:
+            return search_models(input.results_folder(), input.search_query())
+        except ValueError as e:
+            return str(e)
+
+    @render.text
+    def search_info():
+        if isinstance(search(), str):
+            return ui.markdown(search())
+        results, n_vertices = search()
+        return ui.markdown(f'**{len(results)}** maps have clusters overlapping the **{n_vertices}** vertices searched.')
+
+    @render.table
+    def search_results():
+        if isinstance(search(), str):
+            return None
+        return search()[0]
 
 
-app = App(app_ui, server)
+# Serve the Shiny app together with the Prometheus /metrics endpoint. Heavy dependencies are only imported
+# once the server is up (see definitions/lazy_imports.py), while a loader process decodes the meshes and
+# maps into the store shared by all workers (see definitions/shared_store.py) and the results folder is
+# watched for new runs (see definitions/result_watcher.py). The 3D brains are served as cached payloads
+# next to the app (see definitions/figure_cache.py), and the memory held by the sessions can be reported on
+# /sessions (see definitions/session_resources.py)
+app = mount_metrics(App(app_ui, server), routes=figure_routes + session_routes,
+                    on_startup=[prewarm, lambda: start_loader(start_folder), lambda: watch_results(start_folder)])
 
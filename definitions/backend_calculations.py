@@ -1,15 +1,18 @@
 import os
+import hashlib
+import threading
 import numpy as np
-import pandas as pd
 import warnings
 
-from nilearn import datasets
-import nibabel as nb
-
-import matplotlib as mpl
-from matplotlib.colors import ListedColormap
-
 import definitions.layout_styles as styles
+from definitions.instrumentation import timed, record_cache
+from definitions.lazy_imports import lazy_import
+from definitions.shared_store import load_array, decode_mgh, SurfaceViews
+
+pd = lazy_import('pandas')
+datasets = lazy_import('nilearn.datasets')
+mpl = lazy_import('matplotlib')
+mcolors = lazy_import('matplotlib.colors')
 
 # ===== DATA PROCESSING FUNCTIONS ==============================================================
 
@@ -29,7 +32,64 @@ def detect_models(resdir):
     return all_results
 
 
-def extract_results(resdir, group, model, measure):
+def result_map_path(resdir, group, model, measure, hemi, kind):
+    # kind: 'est' (beta map), 'p' (p-values) or 'ocn' (significant clusters)
+    if kind == 'ocn':
+        return f'{resdir}/{group}/{model}/{hemi[0]}h.{measure}.{model}.ocn.mgh'
+    return f'{resdir}/{group}/{model}/{hemi[0]}h.{measure}.{kind}.{model}.mgh'
+
+
+def model_measures(resdir, group, model):
+    # Measures for which the est, p and ocn maps of both hemispheres exist
+    if not os.path.isdir(f'{resdir}/{group}/{model}'):
+        return []
+    files = os.listdir(f'{resdir}/{group}/{model}')
+    measures = sorted({f.split('.')[1] for f in files if f.endswith(f'.est.{model}.mgh')})
+    return [measure for measure in measures
+            if all(os.path.basename(result_map_path(resdir, group, model, measure, hemi, kind)) in files
+                   for hemi in ['left', 'right'] for kind in ['est', 'p', 'ocn'])]
+
+
+def list_result_maps(resdir):
+    # All (group, model, measure) combinations for which the est, p and ocn maps of both hemispheres exist
+    return [(group, model, measure) for group, models in detect_models(resdir).items()
+            for model in models for measure in model_measures(resdir, group, model)]
+
+
+# Data derived from the results trees (indices etc.) is cached outside of them, so that read-only results folders
+# can be browsed: one folder per results tree, named after its resolved path
+CACHE_DIR = os.environ.get('BRAINMAPP_CACHE_DIR',
+                           os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'brainmapp'))
+
+
+def artifact_root(resdir):
+    resdir = os.path.realpath(resdir)
+    key = hashlib.blake2b(resdir.encode(), digest_size=8).hexdigest()
+    return os.path.join(CACHE_DIR, f'{os.path.basename(resdir)}-{key}')
+
+
+def artifact_dir(resdir, name):
+    path = os.path.join(artifact_root(resdir), name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def read_surface_map(path):
+    # Read-only view, shared between calls, sessions and workers (see shared_store.py)
+    return load_array(path, decode_mgh)
+
+
+def read_result_map(resdir, group, model, measure, hemi, kind, resol='fsaverage'):
+    # Result map at a mesh resolution: lower resolutions come from the result pyramids (see pyramids.py)
+    if resol == 'fsaverage':
+        return read_surface_map(result_map_path(resdir, group, model, measure, hemi, kind))
+
+    from definitions.pyramids import pyramid_map
+    return pyramid_map(resdir, group, model, measure, hemi, kind, resol)
+
+
+@timed('extract_results')
+def extract_results(resdir, group, model, measure, resol='fsaverage'):
 
     # stack = detect_models(resdir)[group][model]
 
@@ -44,11 +104,10 @@ def extract_results(resdir, group, model, measure):
 
     for hemi in ['left', 'right']:
         # Read significant clusters
-        ocn = nb.load(f'{resdir}/{group}/{model}/{hemi[0]}h.{measure}.{model}.ocn.mgh')
-        sign_clusters = np.array(ocn.dataobj).flatten()
+        sign_clusters = read_result_map(resdir, group, model, measure, hemi, 'ocn', resol).copy()
 
         # Read the full beta map
-        coef = nb.load(f'{resdir}/{group}/{model}/{hemi[0]}h.{measure}.est.{model}.mgh')
+        coef = read_result_map(resdir, group, model, measure, hemi, 'est', resol)
 
         if not np.any(sign_clusters):  # all zeros = no significant clusters
             betas = np.empty(sign_clusters.shape)
@@ -56,7 +115,7 @@ def extract_results(resdir, group, model, measure):
             n_clusters.append(0)
         else:
             # Read beta map
-            betas = np.array(coef.dataobj).flatten()
+            betas = coef.copy()
 
             # Set non-significant betas to NA
             mask = np.where(sign_clusters == 0)[0]
@@ -73,7 +132,7 @@ def extract_results(resdir, group, model, measure):
 
         sign_clusters_left_right[hemi] = sign_clusters
         sign_betas_left_right[hemi] = betas
-        all_observed_betas_left_right[hemi] = np.array(coef.dataobj).flatten()
+        all_observed_betas_left_right[hemi] = coef
 
     return np.nanmin(min_beta), np.nanmax(max_beta), np.nanmean(med_beta), n_clusters, \
            sign_clusters_left_right, sign_betas_left_right, all_observed_betas_left_right
@@ -86,13 +145,13 @@ def calc_betainfo_bycluster(sign_clusters, sign_betas):
 
     for hemi in ['left', 'right']:
 
-        cst = sign_clusters[
-            hemi].byteswap().newbyteorder()  # ensure that data aligns with the Sys architecture (avoid big-endian)
+        cst = sign_clusters[hemi].astype(
+            sign_clusters[hemi].dtype.newbyteorder('='))  # ensure that data aligns with the Sys architecture (avoid big-endian)
 
         if np.all(cst == 0):
             continue
 
-        bts = sign_betas[hemi].byteswap().newbyteorder()
+        bts = sign_betas[hemi].astype(sign_betas[hemi].dtype.newbyteorder('='))
 
         # Create a DataFrame from the arrays and filter only significant values
         df = pd.DataFrame({'cluster': cst, 'beta': bts})
@@ -115,10 +174,11 @@ def calc_betainfo_bycluster(sign_clusters, sign_betas):
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def compute_overlap(resdir, group1, model1, measure1, group2, model2, measure2):
+@timed('compute_overlap')
+def compute_overlap(resdir, group1, model1, measure1, group2, model2, measure2, resol='fsaverage'):
 
-    sign_clusters1 = extract_results(resdir, group1, model1, measure1)[4]
-    sign_clusters2 = extract_results(resdir, group2, model2, measure2)[4]
+    sign_clusters1 = extract_results(resdir, group1, model1, measure1, resol)[4]
+    sign_clusters2 = extract_results(resdir, group2, model2, measure2, resol)[4]
 
     ovlp_maps = {}
     ovlp_info = {}
@@ -150,13 +210,28 @@ def compute_overlap(resdir, group1, model1, measure1, group2, model2, measure2):
 
 # ===== PLOTTING FUNCTIONS ===================================================================
 
+_surface_cache = {}
+_surface_lock = threading.Lock()  # fetch_surface is called from the render threads of all sessions
+
+
+@timed('fetch_surface')
 def fetch_surface(resolution):
     # Size / number of nodes per map
     n_nodes = {'fsaverage': 163842,
                'fsaverage6': 40962,
                'fsaverage5': 10242}
 
-    return datasets.fetch_surf_fsaverage(mesh=resolution), n_nodes[resolution]
+    with _surface_lock:
+        surfaces = _surface_cache.get(resolution)
+    record_cache('surface_mesh', hit=surfaces is not None)
+
+    if surfaces is None:
+        # Fetched outside of the lock (may download): concurrent first calls keep the views stored first
+        surfaces = SurfaceViews(datasets.fetch_surf_fsaverage(mesh=resolution))
+        with _surface_lock:
+            surfaces = _surface_cache.setdefault(resolution, surfaces)
+
+    return surfaces, n_nodes[resolution]
 
 
 def fetch_discr_colormap(hemi, n_clusters, tot_clusters):
@@ -172,17 +247,17 @@ def fetch_discr_colormap(hemi, n_clusters, tot_clusters):
 
     if n_clusters > 1:
         if hemi == 'left':
-            cmap = ListedColormap(clustcolors[:n_clusters])
+            cmap = mcolors.ListedColormap(clustcolors[:n_clusters])
         else:
-            cmap = ListedColormap(clustcolors[-n_clusters:])
+            cmap = mcolors.ListedColormap(clustcolors[-n_clusters:])
 
     else:
         if hemi == 'left':
-            cmap = ListedColormap(clustcolors)
+            cmap = mcolors.ListedColormap(clustcolors)
         else:
             cmap0_rev = mpl.colormaps[f'{mpl_cmap}_r']
             clustcolors = cmap0_rev(np.linspace(0, 1, 10))
-            cmap = ListedColormap(clustcolors)
+            cmap = mcolors.ListedColormap(clustcolors)
 
     # cmap = ListedColormap(whole_cmap[:n_clusters]) if n_clusters > 0 else None
 
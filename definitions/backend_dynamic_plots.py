@@ -1,51 +1,57 @@
 import numpy as np
 
-from nilearn import plotting
-from matplotlib.colors import ListedColormap
-
 from definitions.backend_calculations import fetch_surface, fetch_discr_colormap, compute_overlap
+from definitions.instrumentation import timed, stage_timer
+from definitions.lazy_imports import lazy_import
 import definitions.layout_styles as styles
 
+plotting = lazy_import('nilearn.plotting')
+mpl = lazy_import('matplotlib')
+mcolors = lazy_import('matplotlib.colors')
+
 
+@timed('plot_surfmap')
 def plot_surfmap(min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
                  surf='pial',  # 'pial', 'infl', 'flat', 'sphere'
                  resol='fsaverage6',
                  output='betas',
                  colorblind=False):
 
-    fs_avg, n_nodes = fetch_surface(resol)
+    fs_avg = fetch_surface(resol)[0]
 
     brain3D = {}
 
     # If no cluster are identified, return empty brain
     if n_clusters[0] == n_clusters[1] == 0:
         for hemi in ['left', 'right']:
-            brain3D[hemi] = plotting.plot_surf(
-                surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-                surf_map=None,  # No statistical map
-                bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
-                darkness=0.3,
-                hemi=hemi,
-                view='lateral',
-                engine='plotly',  # axes=axs[0] # only for matplotlib
-                symmetric_cmap=True,
-                colorbar=False).figure
+            with stage_timer('plot_surf', resol):
+                brain3D[hemi] = plotting.plot_surf(
+                    surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
+                    surf_map=None,  # No statistical map
+                    bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
+                    darkness=0.3,
+                    hemi=hemi,
+                    view='lateral',
+                    engine='plotly',  # axes=axs[0] # only for matplotlib
+                    symmetric_cmap=True,
+                    colorbar=False).figure
         return brain3D
 
 
     for nh, hemi in enumerate(['left', 'right']):
 
         if n_clusters[nh] == 0:
-            brain3D[hemi] = plotting.plot_surf(
-                surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-                surf_map=None,  # No statistical map
-                bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
-                darkness=0.3,
-                hemi=hemi,
-                view='lateral',
-                engine='plotly',  # axes=axs[0] # only for matplotlib
-                symmetric_cmap=True,
-                colorbar=False).figure
+            with stage_timer('plot_surf', resol):
+                brain3D[hemi] = plotting.plot_surf(
+                    surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
+                    surf_map=None,  # No statistical map
+                    bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
+                    darkness=0.3,
+                    hemi=hemi,
+                    view='lateral',
+                    engine='plotly',  # axes=axs[0] # only for matplotlib
+                    symmetric_cmap=True,
+                    colorbar=False).figure
 
             continue
 
@@ -79,23 +85,58 @@ def plot_surfmap(min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
 
             # cmap = styles.BETA_COLORMAP
 
-        brain3D[hemi] = plotting.plot_surf(
+        with stage_timer('plot_surf', resol):
+            brain3D[hemi] = plotting.plot_surf(
+                    surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
+                    surf_map=stats_map,  # Statistical map
+                    bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
+                    darkness=0.6,
+                    hemi=hemi,
+                    view='lateral',
+                    engine='plotly',  # axes=axs[0] # only for matplotlib
+                    cmap=cmap,
+                    symmetric_cmap=False,
+                    colorbar=False,
+                    vmin=min_val, vmax=max_val,
+                    # cbar_vmin=min_val, cbar_vmax=max_val,
+                    avg_method='median',
+                    # title=f'{hemi} hemisphere',
+                    # title_font_size=20,
+                    threshold=thresh
+                ).figure
+
+    return brain3D
+
+
+# ---------------------------------------------------------------------------------------------
+
+
+@timed('plot_overlap')
+def plot_overlap(resdir, group1, model1, measure1, group2, model2, measure2, surf='pial', resol='fsaverage6'):
+
+    ovlp_maps = compute_overlap(resdir, group1, model1, measure1, group2, model2, measure2, resol)[1]
+
+    fs_avg = fetch_surface(resol)[0]
+
+    cmap = mcolors.ListedColormap([styles.OVLP_COLOR1, styles.OVLP_COLOR2, styles.OVLP_COLOR3])
+
+    brain3D = {}
+
+    for hemi in ['left', 'right']:
+
+        with stage_timer('plot_surf', resol):
+            brain3D[hemi] = plotting.plot_surf(
                 surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-                surf_map=stats_map[:n_nodes],  # Statistical map
+                surf_map=ovlp_maps[hemi],  # Statistical map
                 bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
-                darkness=0.6,
+                darkness=0.7,
                 hemi=hemi,
                 view='lateral',
-                engine='plotly',  # axes=axs[0] # only for matplotlib
+                engine='plotly',  # or matplolib # axes=axs[0] # only for matplotlib
                 cmap=cmap,
-                symmetric_cmap=False,
                 colorbar=False,
-                vmin=min_val, vmax=max_val,
-                # cbar_vmin=min_val, cbar_vmax=max_val,
-                avg_method='median',
-                # title=f'{hemi} hemisphere',
-                # title_font_size=20,
-                threshold=thresh
+                vmin=1, vmax=3,
+                threshold=1
             ).figure
 
     return brain3D
@@ -104,30 +145,39 @@ def plot_surfmap(min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
 # ---------------------------------------------------------------------------------------------
 
 
-def plot_overlap(resdir, group1, model1, measure1, group2, model2, measure2, surf='pial', resol='fsaverage6'):
-
-    ovlp_maps = compute_overlap(resdir, group1, model1, measure1, group2, model2, measure2)[1]
+@timed('plot_conjunction')
+def plot_conjunction(conjunction, display='frequency', surf='pial', resol='fsaverage6'):
+    # display: 'frequency' (number of selected models per vertex), 'all' (all-of) or 'any' (any-of) mask
 
-    fs_avg, n_nodes = fetch_surface(resol)
+    fs_avg = fetch_surface(resol)[0]
 
-    cmap = ListedColormap([styles.OVLP_COLOR1, styles.OVLP_COLOR2, styles.OVLP_COLOR3])
+    if display == 'frequency':
+        cmap = mcolors.ListedColormap(mpl.colormaps[styles.CONJUNCTION_COLORMAP](
+            np.linspace(0.2, 1, max(conjunction['n'], 2))))
+        vmin, vmax = 1, max(conjunction['n'], 2)
+    else:
+        cmap = mcolors.ListedColormap([styles.OVLP_COLOR3 if display == 'all' else styles.OVLP_COLOR1] * 2)
+        vmin, vmax = 0, 1
 
     brain3D = {}
 
     for hemi in ['left', 'right']:
 
-        brain3D[hemi] = plotting.plot_surf(
-            surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-            surf_map=ovlp_maps[hemi][:n_nodes],  # Statistical map
-            bg_map=fs_avg[f'sulc_{hemi}'],  # alpha=.2, only in matplotlib
-            darkness=0.7,
-            hemi=hemi,
-            view='lateral',
-            engine='plotly',  # or matplolib # axes=axs[0] # only for matplotlib
-            cmap=cmap,
-            colorbar=False,
-            vmin=1, vmax=3,
-            threshold=1
-        ).figure
+        stats_map = conjunction[display][hemi].astype(float)
+
+        with stage_timer('plot_surf', resol):
+            brain3D[hemi] = plotting.plot_surf(
+                surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
+                surf_map=stats_map if stats_map.any() else None,  # Statistical map (if any vertex is left)
+                bg_map=fs_avg[f'sulc_{hemi}'],
+                darkness=0.7,
+                hemi=hemi,
+                view='lateral',
+                engine='plotly',
+                cmap=cmap,
+                colorbar=display == 'frequency' and stats_map.any(),
+                vmin=vmin, vmax=vmax,
+                threshold=0.5 if stats_map.any() else None
+            ).figure
 
     return brain3D
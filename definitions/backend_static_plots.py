@@ -1,15 +1,20 @@
+import functools
+
 import numpy as np
 
-from nilearn import plotting
+from definitions.backend_calculations import detect_models, extract_results, calc_betainfo_bycluster, fetch_surface
+from definitions.instrumentation import timed
+from definitions.lazy_imports import lazy_import
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.transforms as transforms
-from matplotlib.colors import ListedColormap
+plotting = lazy_import('nilearn.plotting')
 
-from scipy.stats import gaussian_kde
+mpl = lazy_import('matplotlib')
+plt = lazy_import('matplotlib.pyplot')
+transforms = lazy_import('matplotlib.transforms')
+mcolors = lazy_import('matplotlib.colors')
+mcollections = lazy_import('matplotlib.collections')
 
-from definitions.backend_calculations import detect_models, extract_results, calc_betainfo_bycluster, fetch_surface
+stats = lazy_import('scipy.stats')
 
 
 # ===== BETA AND CLUSTER LEGENDS FOR APP ==============================================================
@@ -71,7 +76,7 @@ def plot_beta_colorbar_density(ax1, ax2, sign_betas, all_betas, colorblind=False
         ax1.set_ylim(set_range[0], set_range[1])
 
     # PLOT 2: HISTOGRAM -------------------------------------------------------------------------------
-    density = gaussian_kde(obs_betas)
+    density = stats.gaussian_kde(obs_betas)
 
     # Density line
     ax2.plot(density(lspace), lspace, lw=0.5, alpha=0.3, color='k')
@@ -97,6 +102,7 @@ def plot_beta_colorbar_density(ax1, ax2, sign_betas, all_betas, colorblind=False
     ax2.axis('off')
 
 
+@timed('kde_legend')
 def beta_colorbar_density_figure(sign_betas, all_betas, figsize=(4, 6),
                                  colorblind=False, set_range=None):
 
@@ -117,9 +123,9 @@ def plot_clusterwise_means(fig, ax, df, cmap, tot_clusters):
     cmap0 = mpl.colormaps[cmap]
 
     if tot_clusters > 1:
-        cmap_discr = ListedColormap(cmap0(np.linspace(0, 1, tot_clusters)))
+        cmap_discr = mcolors.ListedColormap(cmap0(np.linspace(0, 1, tot_clusters)))
     else:
-        cmap_discr = ListedColormap(cmap0(np.linspace(0, 1, 10)))
+        cmap_discr = mcolors.ListedColormap(cmap0(np.linspace(0, 1, 10)))
 
     # Plot each line with its corresponding color and error bars
     for n, i in enumerate(df.dropna().index):
@@ -167,6 +173,7 @@ def plot_clusterwise_means(fig, ax, df, cmap, tot_clusters):
             ax.text(y=hemi_label_y, s='Right hemisphere', **hemi_text)
 
 
+@timed('cluster_legend')
 def clusterwise_means_figure(sign_clusters, sign_betas,
                              cmap, tot_clusters, figsize=(4, 6)):
 
@@ -180,11 +187,80 @@ def clusterwise_means_figure(sign_clusters, sign_betas,
     return fig
 
 # ===== STATIC BRAIN PLOTS ==============================================================
+# The brains of the static figure are drawn on flat axes (engine='flat'): each (resolution, surface,
+# hemisphere, view) is projected once with the camera that nilearn's plot_surf uses on 3D axes,
+# back-facing triangles are dropped and the others are sorted back to front. Drawing a view is then
+# one collection of these cached triangles with a colour per face. engine='mplot3d' draws with nilearn as before.
+
+# Camera per view: screen x axis, screen y axis, direction towards the viewer
+# (= matplotlib's view_init(elev, azim) with the (elev, azim) of nilearn's views)
+VIEWS = {'left': {'lateral': ((0, -1, 0), (0, 0, 1), (-1, 0, 0)),
+                  'medial': ((0, 1, 0), (0, 0, 1), (1, 0, 0))},
+         'right': {'lateral': ((0, 1, 0), (0, 0, 1), (1, 0, 0)),
+                   'medial': ((0, -1, 0), (0, 0, 1), (-1, 0, 0))},
+         'both': {'dorsal': ((0, 1, 0), (-1, 0, 0), (0, 0, 1)),
+                  'ventral': ((0, -1, 0), (-1, 0, 0), (0, 0, -1)),
+                  'anterior': ((-1, 0, 0), (0, 0, 1), (0, 1, 0)),
+                  'posterior': ((1, 0, 0), (0, 0, 1), (0, -1, 0))}}
+
+BRAIN_SCALE = 125  # mm of surface per inch of figure, about the size of the brains drawn by mplot3d
+CACHED_VIEWS = 12  # projections kept in memory: the (hemisphere, view) panels of one figure
+
+
+@functools.lru_cache(maxsize=CACHED_VIEWS)
+@timed('project_mesh')
+def projected_mesh(resol, surf, hemi, view):
+    # Triangles of the faces visible from the view, back to front ((faces, 3, 2) float32 array), the
+    # indices of those faces and the 2D bounding box of the mesh
+    coords, faces = fetch_surface(resol)[0][f'{surf}_{hemi}']
+    coords, faces = np.asarray(coords, dtype=float), np.asarray(faces)
+
+    camera = np.array(VIEWS[hemi][view] if view in VIEWS[hemi] else VIEWS['both'][view], dtype=float)
+    screen = coords @ camera.T  # x, y, depth
+
+    # Surface normals point outwards: faces turned away from the viewer are hidden
+    triangles = coords[faces]
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    visible = np.flatnonzero(normals @ camera[2] > 0)
+    visible = visible[np.argsort(screen[faces[visible], 2].mean(axis=1), kind='stable')]
+
+    triangles = np.ascontiguousarray(screen[faces[visible], :2], dtype=np.float32)
+    triangles.flags.writeable = False  # shared by all figures
+
+    return triangles, visible.astype(np.int32), np.array([screen[:, :2].min(axis=0), screen[:, :2].max(axis=0)])
 
 
-def plot_single_brain(ax, hemi, coord, fig, sign_betas, surf='pial', resol='fsaverage5', colorblind=False):
+@functools.lru_cache(maxsize=6)  # 3 resolutions x 2 hemispheres
+def _background_faces(resol, hemi):
+    # Face values of the sulcal depth map, scaled to 0-1 (as in nilearn)
+    fs_avg, _ = fetch_surface(resol)
+    bg_faces = np.asarray(fs_avg[f'sulc_{hemi}'], dtype=float)[fs_avg[f'pial_{hemi}'][1]].mean(axis=1)
+    if bg_faces.min() < 0 or bg_faces.max() > 1:
+        bg_faces = (bg_faces - bg_faces.min()) / (bg_faces.max() - bg_faces.min())
+    return bg_faces
 
-    fs_avg, n_nodes = fetch_surface(resol)
+
+def face_colors(stats_map, hemi, resol, cmap, darkness):
+    # RGBA colour per face: mean of the map over the face vertices on top of the background, faces
+    # touching a vertex outside the clusters (NaN) only show the background
+    faces = fetch_surface(resol)[0][f'pial_{hemi}'][1]
+    colors = plt.cm.gray_r(_background_faces(resol, hemi) * darkness)
+
+    with np.errstate(invalid='ignore'):
+        map_faces = np.asarray(stats_map, dtype=float)[faces].mean(axis=1)
+    kept = ~np.isnan(map_faces)
+    if kept.any():
+        norm = mcolors.Normalize(vmin=map_faces[kept].min(), vmax=map_faces[kept].max())
+        colors[kept] = mpl.colormaps[cmap](norm(map_faces[kept]))
+
+    return colors
+
+
+@timed('plot_surf_static')
+def plot_single_brain(ax, hemi, coord, fig, sign_betas, surf='pial', resol='fsaverage5', colorblind=False,
+                      engine='flat'):
+
+    fs_avg = fetch_surface(resol)[0]
 
     stats_map = sign_betas[hemi]  # sign_betas
     bg_color = fs_avg[f'sulc_{hemi}']
@@ -201,9 +277,22 @@ def plot_single_brain(ax, hemi, coord, fig, sign_betas, surf='pial', resol='fsav
     else:
         cmap = 'viridis' # TODO: could pick a diverging map for this one instead (rare though)
 
+    if engine == 'flat':
+        triangles, visible, bounds = projected_mesh(resol, surf, hemi, coord)
+        colors = face_colors(stats_map, hemi, resol, cmap, bg_darkness)[visible]
+
+        # The projected triangles are shared by all figures, they are already in data coordinates
+        p = mcollections.PolyCollection(triangles, closed=True, facecolors=colors, edgecolors=colors, linewidths=0.1,
+                                        antialiaseds=False)
+        ax.add_collection(p, autolim=False)
+        ax.update_datalim(bounds)
+        ax.autoscale_view()
+        ax.set_aspect('equal', adjustable='datalim')
+        ax.set_axis_off()
+        return p
 
     p = plotting.plot_surf(surf_mesh=fs_avg[f'{surf}_{hemi}'],  # Surface mesh geometry
-                           surf_map=stats_map[:n_nodes],  # Statistical map confounder model
+                           surf_map=stats_map,  # Statistical map confounder model
                            bg_map=bg_color,
                            # alpha=0.01,
                            darkness=bg_darkness,  # of the bg_map
@@ -217,20 +306,31 @@ def plot_single_brain(ax, hemi, coord, fig, sign_betas, surf='pial', resol='fsav
     return p
 
 
-def plot_brain_2d(start_folder, outc, model, meas, resol='fsaverage5', title=None):
+def set_brain_scale(ax, fig, scale=BRAIN_SCALE):
+    # Same scale for all the flat axes of a figure, centred on the brain(s) they show
+    bbox = ax.get_position()
+    width, height = bbox.width * fig.get_figwidth() * scale, bbox.height * fig.get_figheight() * scale
+    (x0, y0), (x1, y1) = ax.dataLim.get_points()
+    ax.set_xlim((x0 + x1 - width) / 2, (x0 + x1 + width) / 2)
+    ax.set_ylim((y0 + y1 - height) / 2, (y0 + y1 + height) / 2)
+
+
+@timed('static_brain_2d')
+def plot_brain_2d(start_folder, outc, model, meas, resol='fsaverage5', title=None, engine='flat'):
 
     title = f'{model} ({meas})' if title == None else title
 
     print("Computing figure")
 
     _, _, _, _, _, sign_betas, all_observed_betas = extract_results(start_folder, outc, model, meas)
+    brain_betas = extract_results(start_folder, outc, model, meas, resol)[5]  # at the resolution of the brains
 
     fig, axs = plt.subplot_mosaic('ABCDD..a.b;EFG.HH.a.b', figsize=(12, 7),
-                                  per_subplot_kw={('ABCDEFGH'): {'projection': '3d'}},
+                                  per_subplot_kw={('ABCDEFGH'): {'projection': '3d'}} if engine == 'mplot3d' else None,
                                   gridspec_kw=dict(wspace=0, hspace=0, width_ratios=[0.19, 0.19, 0.19, 0.02, 0.17,
                                                                                      0.02, 0.08, 0.03, 0.01, 0.1]))
 
-    kargs = dict(sign_betas=sign_betas, fig=fig, surf='pial', resol=resol)
+    kargs = dict(sign_betas=brain_betas, fig=fig, surf='pial', resol=resol, engine=engine)
     tkargs = dict(ha='center', va='center', style='italic', fontsize=10)
 
     plot_single_brain(axs['A'], 'left', 'lateral', **kargs)
@@ -251,11 +351,15 @@ def plot_brain_2d(start_folder, outc, model, meas, resol='fsaverage5', title=Non
     plot_single_brain(axs['H'], 'left', 'anterior', **kargs)
     plot_single_brain(axs['H'], 'right', 'anterior', **kargs)
 
-    axs['A'].set_ylim3d(-88, 90)
-    axs['B'].set_ylim3d(-88, 90)
+    if engine == 'mplot3d':
+        axs['A'].set_ylim3d(-88, 90)
+        axs['B'].set_ylim3d(-88, 90)
 
-    axs['E'].set_ylim3d(-128, 50)
-    axs['F'].set_ylim3d(-128, 50)
+        axs['E'].set_ylim3d(-128, 50)
+        axs['F'].set_ylim3d(-128, 50)
+    else:
+        for ax in 'ABCDEFGH':
+            set_brain_scale(axs[ax], fig)
 
     plot_beta_colorbar_density(axs['a'], axs['b'], sign_betas, all_observed_betas)
 
@@ -0,0 +1,60 @@
+// Draws the 3D brains of the app: figure payloads (see definitions/figure_cache.py) are fetched, their typed
+// array buffers decoded and the figure handed to plotly.js. Clicks on a brain are sent back to Shiny as the
+// index of the clicked vertex.
+(function () {
+  const DTYPES = {f4: Float32Array, f8: Float64Array, u4: Uint32Array, i4: Int32Array, u2: Uint16Array, u1: Uint8Array};
+  const HEX = Array.from({length: 256}, (_, n) => n.toString(16).padStart(2, '0'));
+
+  function decodeBuffer(obj) {
+    const bytes = Uint8Array.from(atob(obj.bdata), c => c.charCodeAt(0));
+    const values = new DTYPES[obj.dtype](bytes.buffer);
+    if (obj.format === 'rgb') {
+      const colors = new Array(obj.shape[0]);
+      for (let v = 0; v < colors.length; v++) {
+        colors[v] = '#' + HEX[values[3 * v]] + HEX[values[3 * v + 1]] + HEX[values[3 * v + 2]];
+      }
+      return colors;
+    }
+    return values;
+  }
+
+  function decode(obj) {
+    if (Array.isArray(obj)) return obj.map(decode);
+    if (obj === null || typeof obj !== 'object') return obj;
+    if (typeof obj.bdata === 'string' && obj.dtype in DTYPES) return decodeBuffer(obj);
+    return Object.fromEntries(Object.entries(obj).map(([k, v]) => [k, decode(v)]));
+  }
+
+  async function draw(el) {
+    const src = el.dataset.src;
+    const figure = decode(await (await fetch(src)).json());
+    if (el.dataset.src !== src) return;  // replaced in the meantime
+
+    if (el.dataset.input) {
+      // clicks need hover events, without showing the hover labels
+      figure.layout.hovermode = 'closest';
+      figure.data.forEach(trace => { trace.hoverinfo = 'none'; });
+    }
+    await Plotly.react(el, figure.data, figure.layout, {responsive: true, displaylogo: false});
+
+    if (el.dataset.input && !el.dataset.listening) {
+      el.dataset.listening = 'true';
+      el.on('plotly_click', event => {
+        if (event.points.length) {
+          Shiny.setInputValue(el.dataset.input, event.points[0].pointNumber, {priority: 'event'});
+        }
+      });
+    }
+  }
+
+  function drawAll(root) {
+    root.querySelectorAll('.brainmapp-brain').forEach(el => {
+      if (el.dataset.drawn !== el.dataset.src) {
+        el.dataset.drawn = el.dataset.src;
+        draw(el).catch(e => console.error('Could not draw brain', e));
+      }
+    });
+  }
+
+  new MutationObserver(() => drawAll(document)).observe(document.documentElement, {childList: true, subtree: true});
+})();
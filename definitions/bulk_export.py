@@ -0,0 +1,188 @@
+import os
+import csv
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from definitions.backend_calculations import fetch_surface, list_result_maps, result_map_path, read_surface_map
+from definitions.instrumentation import timed
+from definitions.lazy_imports import lazy_import
+
+openpyxl = lazy_import('openpyxl')
+
+# ===== BULK TABLE EXPORT ====================================================================
+# Cluster and summary tables of every map of a results tree (group x model x measure x hemisphere),
+# e.g. for supplementary tables. The maps are summarised in a process pool and the rows are written
+# as the maps come in, so the tables are never held in memory as a whole:
+#   .csv / .parquet     <output> (clusters) and <output stem>.summary.<ext> (one row per map and hemisphere)
+#   .xlsx               one workbook, with a "clusters" and a "summary" sheet
+# The peak of a cluster is its most significant vertex (largest -log10(p), then largest |beta|), with
+# its coordinates on the fsaverage pial surface.
+
+CLUSTER_COLUMNS = [('group', 'str'), ('model', 'str'), ('measure', 'str'), ('hemi', 'str'), ('cluster', 'int'),
+                   ('size', 'int'), ('mean_beta', 'float'), ('min_beta', 'float'), ('max_beta', 'float'),
+                   ('peak_vertex', 'int'), ('peak_beta', 'float'), ('peak_neg_log10_p', 'float'),
+                   ('peak_x', 'float'), ('peak_y', 'float'), ('peak_z', 'float')]
+
+SUMMARY_COLUMNS = [('group', 'str'), ('model', 'str'), ('measure', 'str'), ('hemi', 'str'), ('n_clusters', 'int'),
+                   ('n_vertices', 'int'), ('mean_beta', 'float'), ('min_beta', 'float'), ('max_beta', 'float'),
+                   ('max_neg_log10_p', 'float')]
+
+FORMATS = ['.csv', '.parquet', '.xlsx']
+
+
+def map_tables(resdir, group, model, measure):
+    # Cluster rows (without coordinates) and summary rows of one map, both hemispheres
+    clusters, summary = [], []
+    for hemi in ['left', 'right']:
+        labels, betas, logp = [np.asarray(read_surface_map(result_map_path(resdir, group, model, measure, hemi, kind)),
+                                          dtype=float) for kind in ['ocn', 'est', 'p']]
+        vertices = np.flatnonzero(labels > 0)
+
+        # Vertices sorted by cluster, the peak of each cluster last
+        vertices = vertices[np.lexsort((np.abs(betas[vertices]), logp[vertices], labels[vertices]))]
+        cluster_of = labels[vertices].astype(np.int64)
+        ids, starts, sizes = np.unique(cluster_of, return_index=True, return_counts=True)
+        peaks = vertices[starts + sizes - 1]
+
+        b = betas[vertices]
+        if len(vertices):
+            sums, mins, maxs = [ufunc.reduceat(b, starts) for ufunc in (np.add, np.fmin, np.fmax)]
+        else:
+            sums = mins = maxs = np.empty(0)
+
+        for n, cluster in enumerate(ids):
+            clusters.append((group, model, measure, hemi, int(cluster), int(sizes[n]), sums[n] / sizes[n],
+                             mins[n], maxs[n], int(peaks[n]), betas[peaks[n]], logp[peaks[n]]))
+
+        summary.append((group, model, measure, hemi, len(ids), len(vertices),
+                        b.mean() if len(b) else np.nan, b.min() if len(b) else np.nan,
+                        b.max() if len(b) else np.nan, logp[vertices].max() if len(b) else np.nan))
+
+    return clusters, summary
+
+
+def _map_tables(args):
+    return map_tables(*args)
+
+
+def peak_coordinates():
+    # {hemi: fsaverage pial coordinates (vertices x 3)}, None if the mesh is not available
+    try:
+        mesh = fetch_surface('fsaverage')[0]
+        return {hemi: np.asarray(mesh[f'pial_{hemi}'][0], dtype=float) for hemi in ['left', 'right']}
+    except Exception as e:  # e.g. mesh not downloaded and no connection
+        print(f'Exporting without peak coordinates: {e}')
+        return None
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class _CsvTables:
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.files = [open(path, 'w', newline='') for path in paths]
+        self.writers = [csv.writer(f) for f in self.files]
+        for writer, columns in zip(self.writers, [CLUSTER_COLUMNS, SUMMARY_COLUMNS]):
+            writer.writerow([name for name, _ in columns])
+
+    def write(self, clusters, summary):
+        for writer, rows in zip(self.writers, [clusters, summary]):
+            writer.writerows(rows)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+class _ParquetTables:
+
+    def __init__(self, paths):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise RuntimeError('Parquet output needs pyarrow (pip install pyarrow)') from e
+
+        self.paths = paths
+        types = {'str': pyarrow.string(), 'int': pyarrow.int64(), 'float': pyarrow.float64()}
+        self.schemas = [pyarrow.schema([(name, types[kind]) for name, kind in columns])
+                        for columns in [CLUSTER_COLUMNS, SUMMARY_COLUMNS]]
+        self.writers = [pyarrow.parquet.ParquetWriter(path, schema) for path, schema in zip(paths, self.schemas)]
+        self.table = pyarrow.Table.from_pylist
+
+    def write(self, clusters, summary):
+        for writer, schema, rows in zip(self.writers, self.schemas, [clusters, summary]):
+            if rows:
+                writer.write_table(self.table([dict(zip(schema.names, row)) for row in rows], schema=schema))
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class _ExcelTables:
+
+    def __init__(self, path):
+        self.paths = [path]
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheets = [self.workbook.create_sheet(name) for name in ['clusters', 'summary']]
+        for sheet, columns in zip(self.sheets, [CLUSTER_COLUMNS, SUMMARY_COLUMNS]):
+            sheet.append([name for name, _ in columns])
+
+    def write(self, clusters, summary):
+        for sheet, rows in zip(self.sheets, [clusters, summary]):
+            for row in rows:
+                sheet.append([None if isinstance(v, float) and np.isnan(v) else v for v in row])  # empty cells
+
+    def close(self):
+        self.workbook.save(self.paths[0])
+
+
+def _open_tables(output):
+    stem, ext = os.path.splitext(output)
+    if ext == '.xlsx':
+        return _ExcelTables(output)
+    if ext == '.csv':
+        return _CsvTables([output, f'{stem}.summary{ext}'])
+    if ext == '.parquet':
+        return _ParquetTables([output, f'{stem}.summary{ext}'])
+    raise ValueError(f'Unknown output format "{ext}" (expected one of {", ".join(FORMATS)})')
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+@timed('bulk_export')
+def export_tables(resdir, output, max_workers=None):
+    # Write the cluster and summary tables of all the maps of a results tree, returns the number of maps and
+    # clusters written, and the files written (the summary is a separate file for csv / parquet)
+    maps = list_result_maps(resdir)
+    tables = _open_tables(output)
+    coordinates = peak_coordinates()
+
+    n_clusters = 0
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for clusters, summary in pool.map(_map_tables, [(resdir, *m) for m in maps], chunksize=4):
+                clusters = [(*row, *(coordinates[row[3]][row[9]] if coordinates else [np.nan] * 3))
+                            for row in clusters]
+                tables.write(clusters, summary)
+                n_clusters += len(clusters)
+    finally:
+        tables.close()
+
+    return len(maps), n_clusters, tables.paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the cluster and summary tables of a results tree')
+    parser.add_argument('resdir', help='results directory (<group>/<model>/ maps)')
+    parser.add_argument('output', help=f'output file ({", ".join(FORMATS)}), csv / parquet also write the summary '
+                                       f'table to <name>.summary.<ext>')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    n_maps, n_clusters, paths = export_tables(args.resdir, args.output, max_workers=args.workers)
+    print(f'Exported {n_clusters} clusters of {n_maps} maps to {" and ".join(paths)}')
@@ -0,0 +1,59 @@
+import numpy as np
+
+from definitions.backend_calculations import read_result_map
+from definitions.instrumentation import timed
+from definitions.lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+
+# ===== N-WAY CONJUNCTION ====================================================================
+# Cluster membership of any number of (group, model, measure) selections is packed into a bit
+# matrix (one bit per selection, one column per vertex), from which the frequency map, the
+# all-of / any-of masks and the per-combination counts are computed without pairwise loops.
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def selection_label(selection):
+    group, model, measure = selection
+    return f'{model} ({measure})'
+
+
+def membership_bits(resdir, selections, resol='fsaverage'):
+    # {hemi: (ceil(n_selections / 8) x n_vertices) uint8}, bit i of a vertex = significant in selection i
+    bits = {}
+    for hemi in ['left', 'right']:
+        membership = np.stack([read_result_map(resdir, *sel, hemi, 'ocn', resol) > 0 for sel in selections])
+        bits[hemi] = np.packbits(membership, axis=0, bitorder='little')
+    return bits
+
+
+def _combination_counts(bits, n_selections):
+    # Unique bit patterns (one per vertex) and their vertex counts
+    rows = np.ascontiguousarray(bits.T)
+    codes, counts = np.unique(rows.view(np.dtype((np.void, rows.shape[1]))).ravel(), return_counts=True)
+    patterns = np.frombuffer(codes.tobytes(), dtype=np.uint8).reshape(len(codes), rows.shape[1])
+    membership = np.unpackbits(patterns, axis=1, count=n_selections, bitorder='little').astype(bool)
+    return membership, counts
+
+
+@timed('compute_conjunction')
+def compute_conjunction(resdir, selections, resol='fsaverage'):
+
+    n = len(selections)
+    bits = membership_bits(resdir, selections, resol)
+
+    frequency = {hemi: _POPCOUNT[b].sum(axis=0, dtype=np.uint16) for hemi, b in bits.items()}
+    all_of = {hemi: f == n for hemi, f in frequency.items()}
+    any_of = {hemi: f > 0 for hemi, f in frequency.items()}
+
+    # UpSet-style summary: number of vertices for each combination of selections (both hemispheres)
+    membership, counts = _combination_counts(np.concatenate([bits['left'], bits['right']], axis=1), n)
+    keep = membership.any(axis=1)
+
+    combinations = pd.DataFrame(membership[keep], columns=[selection_label(s) for s in selections])
+    combinations.insert(0, 'n_models', membership[keep].sum(axis=1))
+    combinations.insert(0, 'vertices', counts[keep])
+    combinations = combinations.sort_values(['vertices', 'n_models'], ascending=False).reset_index(drop=True)
+
+    return {'frequency': frequency, 'all': all_of, 'any': any_of, 'combinations': combinations, 'n': n}
@@ -0,0 +1,185 @@
+import os
+import gzip
+import json
+import base64
+import hashlib
+import time
+import threading
+import importlib.util
+
+import numpy as np
+from shiny import ui
+from starlette.responses import FileResponse, Response
+from starlette.routing import Route
+
+from definitions.instrumentation import timed, record_cache
+from definitions.shared_store import STORE_DIR
+
+# ===== FIGURE PAYLOADS ======================================================================
+# The 3D brains are not sent through the Shiny websocket as widget JSON. Each figure is encoded once
+# (arrays as base64 typed buffers, gzipped) into a payload file of the shared store, named after a
+# hash of everything it depends on: the map, its colour range, the resolution, the surface and the
+# display mode. Outputs only send a placeholder pointing at /figures/<key>.json, which the browser
+# fetches (and caches), decodes and draws with plotly.js (see brain_view.js). Sessions and workers
+# showing the same map share the same payload.
+
+FORMAT_VERSION = 1
+
+FIGURE_DIR = os.path.join(STORE_DIR, 'figures')
+MAX_CACHE_BYTES = int(os.environ.get('BRAINMAPP_FIGURE_CACHE_MB', 1024)) * 2**20
+PRUNE_GRACE_SECONDS = 600  # payloads sent or served more recently are kept, so open pages can still fetch them
+
+ASSETS = {'brain_view.js': os.path.join(os.path.dirname(__file__), 'brain_view.js'),
+          'plotly.min.js': os.path.join(os.path.dirname(importlib.util.find_spec('plotly').origin), 'package_data',
+                                        'plotly.min.js')}
+
+_write_lock = threading.Lock()
+
+
+def map_hash(*arrays):
+    # Content hash of the map(s) shown in a figure
+    digest = hashlib.blake2b(digest_size=12)
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        digest.update(f'{a.dtype.str}{a.shape}'.encode())
+        digest.update(a.data)
+    return digest.hexdigest()
+
+
+def figure_key(*parts):
+    return hashlib.blake2b(repr((FORMAT_VERSION,) + parts).encode(), digest_size=16).hexdigest()
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _typed_buffer(values):
+    # numpy array -> {'dtype', 'shape', 'bdata'} (little endian), colour lists -> uint8 RGB buffer
+    if isinstance(values, (list, tuple)) and values and isinstance(values[0], str) and values[0].startswith('#'):
+        rgb = np.frombuffer(bytes.fromhex(''.join(c[1:7] for c in values)), dtype=np.uint8)
+        return {'dtype': 'u1', 'shape': [len(values), 3], 'format': 'rgb', 'bdata': base64.b64encode(rgb).decode()}
+
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = values.astype('<f4')
+    elif values.dtype.kind in 'iu' and values.min(initial=0) >= 0:
+        values = values.astype('<u4')
+    elif values.dtype.kind in 'iu':
+        values = values.astype('<i4')
+    else:
+        return values.tolist()
+
+    return {'dtype': values.dtype.str[1:], 'shape': list(values.shape),
+            'bdata': base64.b64encode(np.ascontiguousarray(values).data).decode()}
+
+
+def _encode_arrays(obj):
+    if isinstance(obj, dict):
+        return {k: _encode_arrays(v) for k, v in obj.items()}
+    if isinstance(obj, np.ndarray) or (isinstance(obj, list) and len(obj) > 64):
+        return _typed_buffer(obj)
+    if isinstance(obj, (list, tuple)):
+        return [_encode_arrays(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+@timed('figure_serialization')
+def encode_figure(fig, resol=None):
+    figure = fig.to_plotly_json()
+    payload = {'data': [_encode_arrays(trace) for trace in figure['data']], 'layout': _encode_arrays(figure['layout'])}
+    return gzip.compress(json.dumps(payload, separators=(',', ':')).encode(), compresslevel=6, mtime=0)
+
+
+def _payload_path(key):
+    return os.path.join(FIGURE_DIR, f'{key}.json.gz')
+
+
+def _prune():
+    # Least recently used payloads go first once the cache is over its size limit. The modification time of a
+    # payload is its last use: when its placeholder was sent to a session or when a browser fetched it
+    entries = []
+    for f in os.listdir(FIGURE_DIR):
+        try:
+            st = os.stat(os.path.join(FIGURE_DIR, f))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime_ns, st.st_size, f))
+
+    total = sum(size for _, size, _ in entries)
+    recent = time.time_ns() - PRUNE_GRACE_SECONDS * 10**9
+    for mtime, size, f in sorted(entries):
+        if total <= MAX_CACHE_BYTES or mtime > recent:
+            break
+        try:
+            os.remove(os.path.join(FIGURE_DIR, f))
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def cached_figures(key_parts, build, resol=None):
+    # {hemi: payload key} of a pair of hemisphere figures. build() returns the {hemi: figure} dict and
+    # is only called when the payloads are not cached yet
+    keys = {hemi: figure_key(*key_parts, hemi) for hemi in ['left', 'right']}
+
+    if all(os.path.exists(_payload_path(k)) for k in keys.values()):
+        record_cache('figure_payload', hit=True)
+        for k in keys.values():
+            os.utime(_payload_path(k))
+        return keys
+
+    record_cache('figure_payload', hit=False)
+    figures = build()
+
+    os.makedirs(FIGURE_DIR, exist_ok=True)
+    for hemi, key in keys.items():
+        if figures[hemi] is None:
+            keys[hemi] = None
+            continue
+        payload = encode_figure(figures[hemi], resol=resol)
+        tmp = f'{_payload_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp, _payload_path(key))
+
+    with _write_lock:
+        _prune()
+
+    return keys
+
+# ===== BROWSER SIDE =========================================================================
+
+
+def brain_view(key, click_input=None, height='400px'):
+    # Placeholder drawn by brain_view.js. click_input: (namespaced) input id that receives the clicked vertex
+    if key is None:
+        return None
+    return ui.div(class_='brainmapp-brain', style=f'height: {height}',
+                  **{'data-src': f'figures/{key}.json', 'data-input': click_input or ''})
+
+
+def brain_view_dependencies():
+    return ui.head_content(ui.tags.script(src='figures/assets/plotly.min.js'),
+                           ui.tags.script(src='figures/assets/brain_view.js'))
+
+
+async def _serve_payload(request):
+    path = _payload_path(request.path_params['key'])
+    try:
+        os.utime(path)  # last use, see _prune
+    except FileNotFoundError:
+        return Response(status_code=404)
+    return FileResponse(path, media_type='application/json',
+                        headers={'Content-Encoding': 'gzip', 'Cache-Control': 'public, max-age=31536000, immutable'})
+
+
+async def _serve_asset(request):
+    name = request.path_params['name']
+    if name not in ASSETS:
+        return Response(status_code=404)
+    return FileResponse(ASSETS[name], media_type='text/javascript', headers={'Cache-Control': 'public, max-age=86400'})
+
+
+figure_routes = [Route('/figures/assets/{name}', _serve_asset),
+                 Route('/figures/{key}.json', _serve_payload)]
@@ -0,0 +1,169 @@
+import os
+import time
+import cProfile
+import inspect
+import functools
+import threading
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Mount, Route
+
+# ===== METRICS ==============================================================================
+# Metrics live in the memory of each process. With several uvicorn workers, PROMETHEUS_MULTIPROC_DIR must
+# point to an empty directory when the server starts: every process then writes its metrics to files there,
+# and /metrics adds up those of all the workers (otherwise it only reports the worker serving the request).
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+STAGE_SECONDS = Histogram('brainmapp_stage_seconds',
+                          'Time spent in each processing stage',
+                          ['stage', 'resolution'],
+                          buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+
+CACHE_REQUESTS = Counter('brainmapp_cache_requests_total',
+                         'Cache lookups by cache name and outcome (hit / miss)',
+                         ['cache', 'result'])
+
+WEBSOCKET_SENT = Counter('brainmapp_websocket_sent_bytes_total',
+                         'Size of the messages sent to the browsers over the Shiny websocket')
+
+IMPORT_SECONDS = Gauge('brainmapp_import_seconds',
+                       'Time taken to import the (deferred) heavy dependencies',
+                       ['module'], multiprocess_mode='liveall')  # one value per worker
+
+SESSION_BYTES = Gauge('brainmapp_session_bytes',
+                      'Estimated memory held by the reactive calcs of the open sessions',
+                      ['calc'], multiprocess_mode='livesum')
+
+SESSIONS_OPEN = Gauge('brainmapp_sessions_open',
+                      'Sessions open',
+                      multiprocess_mode='livesum')
+
+SESSION_RELEASES = Counter('brainmapp_session_releases_total',
+                           'Session values released to free memory, by reason (idle / memory)',
+                           ['reason'])
+
+NO_RESOLUTION = 'na'  # label for stages that do not depend on the mesh resolution
+
+
+@contextmanager
+def stage_timer(stage, resolution=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage, resolution or NO_RESOLUTION).observe(time.perf_counter() - start)
+
+
+def _resolution_of(signature, args, kwargs):
+    # Resolution is passed around as `resol` (plotting) or `resolution` (fetch_surface)
+    bound = signature.bind_partial(*args, **kwargs)
+    bound.apply_defaults()
+    return bound.arguments.get('resol', bound.arguments.get('resolution'))
+
+
+def timed(stage):
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage, _resolution_of(signature, args, kwargs)):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+# ===== PROFILING ============================================================================
+# Set BRAINMAPP_PROFILE_DIR to dump a cProfile of the next request (.prof, readable with pstats
+# or snakeviz). POST /profile re-arms the profiler for one more request.
+
+
+PROFILE_DIR = os.environ.get('BRAINMAPP_PROFILE_DIR')
+
+_profile_lock = threading.Lock()
+_profile_armed = PROFILE_DIR is not None
+
+
+def arm_profiler():
+    global _profile_armed
+    with _profile_lock:
+        _profile_armed = PROFILE_DIR is not None
+    return _profile_armed
+
+
+def _take_profile_slot():
+    global _profile_armed
+    with _profile_lock:
+        armed, _profile_armed = _profile_armed, False
+    return armed
+
+
+@contextmanager
+def profile_request(name):
+    if not _take_profile_slot():
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f'{name}_{time.strftime("%Y%m%d-%H%M%S")}.prof'))
+
+# ===== ASGI =================================================================================
+
+
+def time_websocket_transfer(asgi_app):
+    # Shiny pushes rendered outputs through the websocket:
+    # time how long each message takes to be handed over to the client connection
+    async def app(scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await asgi_app(scope, receive, send)
+
+        async def timed_send(message):
+            if message['type'] != 'websocket.send':
+                return await send(message)
+
+            with stage_timer('websocket_transfer'):
+                await send(message)
+            WEBSOCKET_SENT.inc(len(message.get('text') or message.get('bytes') or ''))
+
+        return await asgi_app(scope, receive, timed_send)
+
+    return app
+
+
+def mount_metrics(shiny_app, routes=(), on_startup=()):
+
+    async def metrics(request):
+        if MULTIPROC_DIR is None:
+            return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)  # all the workers
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+    async def rearm_profiler(request):
+        return PlainTextResponse('armed\n' if arm_profiler() else 'profiling disabled\n')
+
+    routes = [Route('/metrics', metrics), *routes]
+    if PROFILE_DIR is not None:
+        routes.append(Route('/profile', rearm_profiler, methods=['POST']))
+    routes.append(Mount('/', app=time_websocket_transfer(shiny_app)))
+
+    # The gauges of a worker that stopped are no longer reported
+    on_shutdown = [lambda: multiprocess.mark_process_dead(os.getpid())] if MULTIPROC_DIR is not None else []
+
+    return Starlette(routes=routes, on_startup=list(on_startup), on_shutdown=on_shutdown)
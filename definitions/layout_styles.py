@@ -18,5 +18,4 @@ OVLP_COLOR3 = '#CC6677'  # light red
 
 OVLP_COLORS = [OVLP_COLOR1, OVLP_COLOR2, OVLP_COLOR3]
 
-
-
+CONJUNCTION_COLORMAP = 'YlOrRd'
@@ -0,0 +1,76 @@
+import sys
+import time
+import types
+import importlib
+import threading
+
+from definitions.instrumentation import IMPORT_SECONDS
+
+# ===== DEFERRED IMPORTS =====================================================================
+# nilearn, scipy, matplotlib, pandas and nibabel take most of the start-up time of a worker, but
+# none of them is needed before GO is pressed. Modules are imported on first attribute access
+# and pre-warmed in the background once the server is up.
+
+_lazy_modules = {}
+_import_times = {}
+_import_lock = threading.Lock()
+
+
+def _load(name):
+    if name in _import_times:
+        return sys.modules[name]
+
+    with _import_lock:
+        if name not in _import_times:
+            start = time.perf_counter()
+            importlib.import_module(name)
+            _import_times[name] = time.perf_counter() - start
+            IMPORT_SECONDS.labels(name).set(_import_times[name])
+
+    return sys.modules[name]
+
+
+class _LazyModule(types.ModuleType):
+
+    def __getattr__(self, attr):
+        module = _load(self.__name__)
+        # Copy the loaded namespace so next lookups do not go through here anymore
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    if name not in _lazy_modules:
+        _lazy_modules[name] = _LazyModule(name)
+    return _lazy_modules[name]
+
+
+def import_report():
+    # Seconds spent importing each deferred module, in import order (nested imports are
+    # attributed to the module that triggered them)
+    return dict(_import_times)
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _prewarm(tasks):
+    start = time.perf_counter()
+
+    for name in list(_lazy_modules):
+        _load(name)
+
+    for task in tasks:
+        try:
+            task()
+        except Exception as e:  # pre-warming is best effort, the request will retry and report it
+            print(f'Pre-warming {getattr(task, "__name__", task)} failed: {e}')
+
+    report = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in import_report().items())
+    print(f'Pre-warmed in {time.perf_counter() - start:.2f}s ({report})')
+
+
+def prewarm(*tasks):
+    # Import all deferred modules (then run the optional warm-up tasks) in a background thread
+    thread = threading.Thread(target=_prewarm, args=(tasks,), name='brainmapp-prewarm', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,333 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+
+import numpy as np
+import psutil
+import requests
+import websockets
+
+from definitions.backend_calculations import list_result_maps, result_map_path
+from definitions.shared_store import decode_mgh
+
+# ===== LOAD TEST ============================================================================
+# Starts the app locally (or targets a running one) and drives N simulated browser sessions over the
+# Shiny websocket. Each session clicks GO on the welcome page and in result1 / result2, switches the
+# resolution, opens the Overlap tab and downloads the PNG figure, fetching the brain payloads like a
+# browser would. Per-action latencies, throughput and the RSS of the server processes over time are
+# written as a JSON report.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESULT_OUTPUTS = ['info', 'brain_left', 'brain_right', 'color_legend']
+OVERLAP_OUTPUTS = ['overlap_info', 'overlap_brain_left', 'overlap_brain_right']
+
+
+class ActionError(Exception):
+    pass
+
+
+class SimulatedSession:
+    # One browser tab: a websocket connection, the inputs it sent and the outputs it received
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.inputs = {}
+        self.values = {}
+        self.received = set()
+        self.session_id = None
+        self.flushes = 0
+        self._changed = asyncio.Condition()
+
+    async def _receive(self):
+        async for message in self.ws:
+            message = json.loads(message)
+            async with self._changed:
+                if 'config' in message:
+                    self.session_id = message['config']['sessionId']
+                if 'values' in message:
+                    self.flushes += 1
+                for name, value in (message.get('values') or {}).items():
+                    self.values[name] = value
+                    self.received.add(name)
+                for name, error in (message.get('errors') or {}).items():
+                    self.values[name] = ActionError(error.get('message'))
+                    self.received.add(name)
+                self._changed.notify_all()
+
+    async def connect(self, inputs):
+        ws_url = re.sub('^http', 'ws', self.base_url) + '/websocket/'
+        self.ws = await websockets.connect(ws_url, max_size=None)
+        self.receiver = asyncio.create_task(self._receive())
+
+        self.inputs.update(inputs)
+        await self.ws.send(json.dumps({'method': 'init', 'data': inputs}))
+
+        # The first outputs (rendered from the initial inputs) must not be mistaken for the later ones
+        async with self._changed:
+            await asyncio.wait_for(self._changed.wait_for(lambda: self.flushes > 0), self.timeout)
+
+    async def update(self, inputs, wait_for=()):
+        # Send input changes and wait until all the `wait_for` outputs were (re)rendered
+        async with self._changed:
+            self.received -= set(wait_for)
+        self.inputs.update(inputs)
+        await self.ws.send(json.dumps({'method': 'update', 'data': inputs}))
+
+        async with self._changed:
+            await asyncio.wait_for(self._changed.wait_for(lambda: set(wait_for) <= self.received), self.timeout)
+
+        errors = [f'{name}: {self.values[name]}' for name in wait_for if isinstance(self.values[name], ActionError)]
+        if errors:
+            raise ActionError('; '.join(errors))
+
+    def click(self, button):
+        key = f'{button}:shiny.action'
+        return {key: self.inputs.get(key, 0) + 1}
+
+    def figure_sources(self, outputs):
+        # Brain outputs are placeholders pointing at their figure payloads
+        html = [v.get('html', '') for v in map(self.values.get, outputs) if isinstance(v, dict)]
+        return [src for h in html for src in re.findall(r'data-src="([^"]+)"', h)]
+
+    async def fetch_figures(self, sources):
+        # Get the payloads as the browser does
+        for src in sources:
+            response = await asyncio.to_thread(requests.get, f'{self.base_url}/{src}', timeout=self.timeout)
+            response.raise_for_status()
+
+    async def download(self, output_id):
+        url = f'{self.base_url}/session/{self.session_id}/download/{output_id}?w='
+        response = await asyncio.to_thread(requests.get, url, timeout=self.timeout)
+        response.raise_for_status()
+        return len(response.content)
+
+    async def close(self):
+        await self.ws.close()
+        self.receiver.cancel()
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _visible(outputs, hidden=False):
+    # Shiny only renders the outputs that the browser reports as visible (and sized, for plots)
+    data = {}
+    for name in outputs:
+        data[f'.clientdata_output_{name}_hidden'] = hidden
+        data[f'.clientdata_output_{name}_width'] = 400
+        data[f'.clientdata_output_{name}_height'] = 400
+    return data
+
+
+def scenario_maps(resdir):
+    # Maps with at least one cluster (the others render no brains), or all maps when there are too few
+    maps = list_result_maps(resdir)
+    with_clusters = [m for m in maps if any(decode_mgh(result_map_path(resdir, *m, hemi, 'ocn')).any()
+                                            for hemi in ['left', 'right'])]
+    return with_clusters if len(with_clusters) >= 2 else maps
+
+
+def _pair(rng, maps):
+    # Two different maps, of the same measure when possible (so that the overlap tab has something to show)
+    first = rng.choice(maps)
+    same = [m for m in maps if m[2] == first[2] and m != first]
+    return first, rng.choice(same or [m for m in maps if m != first])
+
+
+def _selection(module, selection, resolution):
+    group, model, measure = selection
+    return {f'{module}-select_pheno': group, f'{module}-select_model': model, f'{module}-select_measure': measure,
+            f'{module}-select_output': 'betas', f'{module}-select_surface': 'pial',
+            f'{module}-select_resolution': resolution}
+
+
+async def _fetch(records, session, outputs):
+    sources = session.figure_sources(outputs)
+    if sources:
+        await _timed(records, 'fetch_figures', session.fetch_figures(sources))
+
+
+async def _timed(records, name, action):
+    start = time.perf_counter()
+    try:
+        await action
+        records.append((name, time.perf_counter() - start, None))
+    except Exception as e:
+        records.append((name, time.perf_counter() - start, f'{type(e).__name__}: {e}'))
+        raise
+
+
+async def run_session(base_url, resdir, maps, resolutions, iterations, timeout, seed, records):
+    rng = random.Random(seed)
+    session = SimulatedSession(base_url, timeout)
+
+    outputs = [f'{m}-{o}' for m in ['result1', 'result2'] for o in RESULT_OUTPUTS]
+    await _timed(records, 'connect', session.connect({
+        'results_folder': resdir, 'navbar': 'tab1', '.clientdata_pixelratio': 1,
+        'overlap_select_surface': 'pial', 'overlap_select_resolution': resolutions[0],
+        **_visible(['output_results_folder', *outputs]), **_visible(OVERLAP_OUTPUTS, hidden=True)}))
+
+    shown_overlap = None
+    try:
+        await _timed(records, 'go_welcome', session.update(session.click('go_button'),
+                                                           wait_for=['output_results_folder']))
+
+        for _ in range(iterations):
+            selections = _pair(rng, maps)
+            resolution = rng.choice(resolutions)
+
+            await session.update({'navbar': 'tab2'})
+            for module, selection in zip(['result1', 'result2'], selections):
+                wait_for = [f'{module}-{o}' for o in RESULT_OUTPUTS]
+                await session.update(_selection(module, selection, resolution))
+                await _timed(records, f'go_{module}', session.update(session.click(f'{module}-update_button'),
+                                                                     wait_for=wait_for))
+                await _fetch(records, session, wait_for)
+
+            # Switch the resolution of result1 and redraw
+            other = rng.choice([r for r in resolutions if r != resolution] or resolutions)
+            wait_for = [f'result1-{o}' for o in RESULT_OUTPUTS]
+            await session.update({'result1-select_resolution': other})
+            await _timed(records, 'switch_resolution', session.update(session.click('result1-update_button'),
+                                                                      wait_for=wait_for))
+            await _fetch(records, session, wait_for)
+
+            # Overlap tab (its outputs become visible, and are only rendered again when the selection changed)
+            wait_for = OVERLAP_OUTPUTS if (selections, other) != shown_overlap else []
+            shown_overlap = (selections, other)
+            await _timed(records, 'open_overlap', session.update({'navbar': 'tab3', 'overlap_select_resolution': other,
+                                                                  **_visible(OVERLAP_OUTPUTS)}, wait_for=wait_for))
+            await _fetch(records, session, OVERLAP_OUTPUTS)
+            await session.update(_visible(OVERLAP_OUTPUTS, hidden=True))
+
+            await _timed(records, 'download_png', session.download('result1-download_figure_button'))
+    finally:
+        await session.close()
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def start_server(port, workers):
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(port),
+                               '--workers', str(workers), '--log-level', 'warning'], cwd=REPO_DIR)
+    for _ in range(600):
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/', timeout=1).status_code == 200:
+                return server
+        except requests.ConnectionError:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError('The server exited during start-up')
+        time.sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError('The server did not start')
+
+
+def process_rss(pid):
+    # RSS of a process and all its children (workers, loader), in bytes
+    try:
+        process = psutil.Process(pid)
+        return sum(p.memory_info().rss for p in [process, *process.children(recursive=True)])
+    except psutil.NoSuchProcess:
+        return 0
+
+
+async def sample_rss(pid, interval, samples, start):
+    while True:
+        samples.append({'t': round(time.perf_counter() - start, 2), 'rss_mb': round(process_rss(pid) / 2**20, 1)})
+        await asyncio.sleep(interval)
+
+
+def summarize(records, samples, duration, config):
+    actions = {}
+    for name in dict.fromkeys(r[0] for r in records):
+        latencies = np.array([t for n, t, error in records if n == name and error is None])
+        errors = [error for n, _, error in records if n == name and error is not None]
+        actions[name] = {'count': len(latencies), 'errors': len(errors),
+                         **({f'p{q}_s': round(float(np.percentile(latencies, q)), 4) for q in [50, 90, 95, 99]} |
+                            {'mean_s': round(float(latencies.mean()), 4), 'max_s': round(float(latencies.max()), 4)}
+                            if len(latencies) else {})}
+
+    completed = sum(a['count'] for a in actions.values())
+    return {'config': config,
+            'duration_s': round(duration, 2),
+            'completed_actions': completed,
+            'failed_actions': sum(a['errors'] for a in actions.values()),
+            'throughput_actions_per_s': round(completed / duration, 3) if duration else None,
+            'actions': actions,
+            'peak_rss_mb': max((s['rss_mb'] for s in samples), default=None),
+            'rss': samples,
+            'first_errors': [f'{n}: {e}' for n, _, e in records if e is not None][:20]}
+
+
+async def run_load_test(base_url, sessions, iterations, resdir, resolutions, server_pid=None, ramp_up=1.0,
+                        timeout=300, sample_interval=0.5, seed=0):
+
+    maps = scenario_maps(os.path.join(REPO_DIR, resdir))
+    if len(maps) < 2:
+        raise RuntimeError(f'At least two result maps are needed in {resdir}')
+
+    records, samples = [], []
+    start = time.perf_counter()
+    sampler = asyncio.create_task(sample_rss(server_pid, sample_interval, samples, start)) if server_pid else None
+
+    async def delayed(n):
+        await asyncio.sleep(ramp_up * n / max(sessions, 1))
+        await run_session(base_url, resdir, maps, resolutions, iterations, timeout, seed + n, records)
+
+    results = await asyncio.gather(*[delayed(n) for n in range(sessions)], return_exceptions=True)
+    duration = time.perf_counter() - start
+
+    if sampler is not None:
+        sampler.cancel()
+
+    config = {'url': base_url, 'sessions': sessions, 'iterations': iterations, 'resdir': resdir,
+              'resolutions': list(resolutions), 'ramp_up_s': ramp_up, 'seed': seed,
+              'aborted_sessions': sum(isinstance(r, Exception) for r in results)}
+    report = summarize(records, samples, duration, config)
+    report['session_errors'] = [f'{type(r).__name__}: {r}' for r in results if isinstance(r, Exception)]
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate concurrent sessions of the app and report latencies')
+    parser.add_argument('--sessions', type=int, default=4, help='number of concurrent sessions')
+    parser.add_argument('--iterations', type=int, default=2, help='scenario repetitions per session')
+    parser.add_argument('--url', default=None, help='URL of a running app (by default, one is started locally)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers of the local server')
+    parser.add_argument('--resdir', default='./results', help='results folder, as typed in the app')
+    parser.add_argument('--resolutions', nargs='+', default=['fsaverage5', 'fsaverage6'])
+    parser.add_argument('--ramp-up', type=float, default=1.0, help='seconds over which the sessions are started')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds before an action is considered failed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='load_test_report.json')
+    args = parser.parse_args()
+
+    server = None if args.url else start_server(args.port, args.workers)
+    try:
+        report = asyncio.run(run_load_test(args.url or f'http://127.0.0.1:{args.port}', args.sessions, args.iterations,
+                                           args.resdir, args.resolutions, server_pid=server.pid if server else None,
+                                           ramp_up=args.ramp_up, timeout=args.timeout, seed=args.seed))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f'{report["completed_actions"]} actions ({report["failed_actions"]} failed) in {report["duration_s"]} s, '
+          f'{report["throughput_actions_per_s"]} actions/s, peak RSS {report["peak_rss_mb"]} MB')
+    for name, stats in report['actions'].items():
+        if stats['count']:
+            print(f'  {name:<18} n={stats["count"]:<4} p50={stats["p50_s"]:.3f}s p95={stats["p95_s"]:.3f}s '
+                  f'max={stats["max_s"]:.3f}s errors={stats["errors"]}')
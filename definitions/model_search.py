@@ -0,0 +1,247 @@
+import os
+import re
+import sys
+import json
+import fcntl
+import hashlib
+import threading
+
+import numpy as np
+
+from definitions.backend_calculations import artifact_dir
+from definitions.instrumentation import timed
+from definitions.lazy_imports import lazy_import
+from definitions.vertex_index import INDEX_NAME as VERTEX_INDEX_NAME, ensure_vertex_index
+
+pd = lazy_import('pandas')
+
+# ===== MODEL SEARCH =========================================================================
+# Inverted index answering "which models have clusters here?". For each table of the vertex index
+# (hemisphere x measure), the cluster maps of all models are packed into one bit per model and vertex,
+# and OR-ed per block of BLOCK_SIZE vertices:
+#   <artifact_root>/model_search/catalog.json     columns, source hash and cluster size of each table
+#   <artifact_root>/model_search/<hemi>.<measure>.npz
+# A query (vertices, or the clusters of a model) first keeps the models present in the blocks it
+# touches, and then counts the exact overlap at its vertices, for those models only.
+
+INDEX_NAME = 'model_search'
+FORMAT_VERSION = 1
+BLOCK_SIZE = 512
+
+HEMIS = {'lh': 'left', 'rh': 'right', 'left': 'left', 'right': 'right'}
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _source_hash(table_info):
+    # Identifies the vertex index table (its columns and their source files) a search table was built from
+    return hashlib.blake2b(json.dumps(table_info, sort_keys=True).encode(), digest_size=12).hexdigest()
+
+
+def _read_catalog(index_dir):
+    try:
+        with open(os.path.join(index_dir, 'catalog.json')) as f:
+            catalog = json.load(f)
+        return catalog if catalog.get('format') == FORMAT_VERSION else {'format': FORMAT_VERSION, 'tables': {}}
+    except FileNotFoundError:
+        return {'format': FORMAT_VERSION, 'tables': {}}
+
+
+def _write_catalog(index_dir, catalog):
+    tmp = os.path.join(index_dir, f'catalog.json.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(catalog, f)
+    os.replace(tmp, os.path.join(index_dir, 'catalog.json'))
+
+
+def search_table(ocn):
+    # Bits of the models significant at each vertex (vertices x ceil(models / 8)) and at each block
+    bits = np.packbits(np.asarray(ocn) > 0, axis=1, bitorder='little')
+    blocks = np.bitwise_or.reduceat(bits, np.arange(0, len(bits), BLOCK_SIZE), axis=0)
+    return bits, blocks
+
+
+@timed('build_model_search')
+def ensure_search_index(resdir, vertex_catalog=None):
+    # (Re)build the search tables whose vertex index table changed, returns the catalog.
+    # vertex_catalog: catalog of an up-to-date vertex index (brought up to date by default)
+    vertex_catalog = ensure_vertex_index(resdir) if vertex_catalog is None else vertex_catalog
+    vertex_dir = artifact_dir(resdir, VERTEX_INDEX_NAME)
+    index_dir = artifact_dir(resdir, INDEX_NAME)
+
+    with open(os.path.join(index_dir, 'build.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # e.g. several workers opening the index at start-up
+        catalog = _read_catalog(index_dir)
+        changed_tables = False
+        for table, info in vertex_catalog['tables'].items():
+            source = _source_hash(info)
+            if catalog['tables'].get(table, {}).get('source') == source:
+                continue
+
+            ocn = np.load(os.path.join(vertex_dir, f'{table}.ocn.npy'), mmap_mode='r')
+            bits, blocks = search_table(ocn)
+            tmp = os.path.join(index_dir, f'{table}.{os.getpid()}.tmp.npz')
+            np.savez_compressed(tmp, bits=bits, blocks=blocks)
+            os.replace(tmp, os.path.join(index_dir, f'{table}.npz'))
+
+            sizes = np.unpackbits(bits, axis=1, count=len(info['columns']), bitorder='little').sum(axis=0)
+            catalog['tables'][table] = {'columns': info['columns'], 'source': source, 'sizes': sizes.tolist()}
+            changed_tables = True
+
+        for table in set(catalog['tables']) - set(vertex_catalog['tables']):
+            del catalog['tables'][table]
+            changed_tables = True
+
+        if changed_tables:
+            _write_catalog(index_dir, catalog)
+
+    return catalog
+
+
+def _open_index(resdir):
+    # Search tables in memory, reloaded when the catalog changed. The first opening in a process makes
+    # sure that the index is up to date
+    index_dir = artifact_dir(resdir, INDEX_NAME)
+    catalog_path = os.path.join(index_dir, 'catalog.json')
+
+    with _indexes_lock:
+        cached = _indexes.get(index_dir)
+        if cached is not None and os.path.exists(catalog_path) and cached[0] == os.stat(catalog_path).st_mtime_ns:
+            return cached[1]
+
+    catalog = ensure_search_index(resdir) if cached is None else _read_catalog(index_dir)
+    tables = {}
+    for table, info in catalog['tables'].items():
+        with np.load(os.path.join(index_dir, f'{table}.npz')) as npz:
+            tables[table] = (info['columns'], np.array(info['sizes']), npz['bits'], npz['blocks'])
+
+    with _indexes_lock:
+        _indexes[index_dir] = (os.stat(catalog_path).st_mtime_ns, tables)
+
+    return tables
+
+# ===== QUERIES ==============================================================================
+
+
+def _hemi_sizes(resdir):
+    # {hemi: number of vertices} of the indexed hemispheres
+    return {table.split('.')[0]: len(bits) for table, (_, _, bits, _) in _open_index(resdir).items()}
+
+
+def _parse_vertices(spec, n_vertices):
+    # '100-200,305' -> array of vertex indices, ranges clipped to the n_vertices of the hemisphere
+    vertices = []
+    for part in spec.split(','):
+        start, dash, stop = part.partition('-')
+        if not start.isdigit() or (dash and not stop.isdigit()):
+            raise ValueError(f'Could not understand the vertex range "{part}" (e.g. 100-200 or 305)')
+        start, stop = int(start), int(stop) if dash else int(start)
+        if stop < start:
+            raise ValueError(f'The vertex range "{part}" is empty (its end comes before its start)')
+        if start >= n_vertices:
+            raise ValueError(f'The vertex range "{part}" is outside the hemisphere (vertices 0-{n_vertices - 1})')
+        vertices.append(np.arange(start, min(stop + 1, n_vertices), dtype=np.int64))
+    return np.unique(np.concatenate(vertices))
+
+
+def cluster_vertices(resdir, group, model, measure=None, cluster=None, hemi=None):
+    # {hemi: vertices} of the clusters of a model (of one measure, one cluster and one hemisphere if given)
+    region = {}
+    vertex_dir = artifact_dir(resdir, VERTEX_INDEX_NAME)
+    for table, (columns, *_) in _open_index(resdir).items():
+        table_hemi, table_measure = table.split('.')
+        if [group, model] not in columns or (measure or table_measure) != table_measure or \
+                (hemi or table_hemi) != table_hemi:
+            continue
+
+        ocn = np.load(os.path.join(vertex_dir, f'{table}.ocn.npy'), mmap_mode='r')[:, columns.index([group, model])]
+        vertices = np.flatnonzero(ocn == cluster if cluster is not None else ocn > 0)
+        region[table_hemi] = np.union1d(region.get(table_hemi, []), vertices).astype(np.int64)
+    return region
+
+
+def parse_query(resdir, query):
+    # Query -> ({hemi: vertices}, models of the query: (group, model, measure or None)). Terms (combined with
+    # spaces):
+    #   lh:100-200,305 rh:12           vertices (ranges) of the left / right hemisphere
+    #   SCZ/SCZ   SCZ/SCZ/thickness    all clusters of a model (of one measure)
+    #   SCZ/SCZ/thickness:lh2          one cluster (lh / rh + number, or a number for both hemispheres)
+    region, exclude = {}, set()
+    for term in query.split():
+        if (match := re.fullmatch(r'(lh|rh|left|right):([\d,\-]+)', term)):
+            n_vertices = _hemi_sizes(resdir).get(HEMIS[match[1]])
+            if n_vertices is None:
+                raise ValueError(f'No maps of the {HEMIS[match[1]]} hemisphere are indexed')
+            parts = {HEMIS[match[1]]: _parse_vertices(match[2], n_vertices)}
+        elif (match := re.fullmatch(r'([^/:]+)/([^/:]+)(?:/([^/:]+))?(?::(lh|rh)?(\d+))?', term)):
+            group, model, measure, hemi, cluster = match.groups()
+            parts = cluster_vertices(resdir, group, model, measure, int(cluster) if cluster else None, HEMIS.get(hemi))
+            if not any(len(v) for v in parts.values()):
+                raise ValueError(f'No clusters found for "{term}"')
+            exclude.add((group, model, measure))
+        else:
+            raise ValueError(f'Could not understand "{term}" (e.g. SCZ/SCZ/thickness:lh1 or lh:100-200)')
+
+        for hemi, vertices in parts.items():
+            region[hemi] = np.union1d(region.get(hemi, []), vertices).astype(np.int64)
+
+    return region, exclude
+
+
+def search_region(resdir, region, exclude=()):
+    # Models with clusters in a region ({hemi: vertices}): list of (group, model, measure, overlap, model size),
+    # by decreasing overlap, and the number of distinct indexed vertices of the region they were counted at.
+    # exclude: (group, model, measure) to leave out (measure None: all measures)
+    sizes_by_hemi = _hemi_sizes(resdir)
+    region = {hemi: np.unique(np.asarray(vertices, dtype=np.int64)) for hemi, vertices in region.items()
+              if hemi in sizes_by_hemi}
+    region = {hemi: vertices[(vertices >= 0) & (vertices < sizes_by_hemi[hemi])] for hemi, vertices in region.items()}
+    n_query = sum(len(vertices) for vertices in region.values())
+
+    overlaps, sizes = {}, {}
+    for table, (columns, table_sizes, bits, blocks) in _open_index(resdir).items():
+        hemi, measure = table.split('.')
+        vertices = region.get(hemi)
+        if vertices is None or not len(vertices):
+            continue
+
+        # Models present in any of the blocks of the region, then exact counts at its vertices
+        candidates = np.flatnonzero(np.unpackbits(np.bitwise_or.reduce(blocks[np.unique(vertices // BLOCK_SIZE)]),
+                                                  count=len(columns), bitorder='little'))
+        if not len(candidates):
+            continue
+        counts = np.unpackbits(bits[vertices], axis=1, count=len(columns), bitorder='little')[:, candidates].sum(axis=0)
+
+        for n, count in zip(candidates, counts):
+            key = (*columns[n], measure)
+            if count and key not in exclude and (*columns[n], None) not in exclude:
+                overlaps[key] = overlaps.get(key, 0) + int(count)
+        for n, (group, model) in enumerate(columns):
+            sizes[(group, model, measure)] = sizes.get((group, model, measure), 0) + int(table_sizes[n])
+
+    return sorted(((*key, overlap, sizes[key]) for key, overlap in overlaps.items()),
+                  key=lambda r: (-r[3], r[:3])), n_query
+
+
+@timed('model_search')
+def search_models(resdir, query):
+    # Ranked models for a query (see parse_query), as a table
+    region, exclude = parse_query(resdir, query)
+    rows, n_query = search_region(resdir, region, exclude)
+
+    table = pd.DataFrame(rows,
+                         columns=['Phenotype', 'Model', 'Measure', 'Overlap (vertices)', 'Model clusters (vertices)'])
+    table.insert(4, '% of query', (100 * table['Overlap (vertices)'] / max(n_query, 1)).round(1))
+    table.insert(6, '% of model', (100 * table['Overlap (vertices)'] / table['Model clusters (vertices)']).round(1))
+    return table, n_query
+
+
+if __name__ == '__main__':
+    resdir = sys.argv[1] if len(sys.argv) > 1 else './results'
+    if len(sys.argv) > 2:
+        results, n_vertices = search_models(resdir, ' '.join(sys.argv[2:]))
+        print(f'{len(results)} models overlap the {n_vertices} vertices of the query')
+        print(results.to_string(index=False))
+    else:
+        print(f'Indexed tables: {", ".join(ensure_search_index(resdir)["tables"])}')
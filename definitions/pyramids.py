@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from definitions.backend_calculations import (fetch_surface, list_result_maps, model_measures, result_map_path,
+                                              read_surface_map, artifact_dir)
+from definitions.instrumentation import timed, record_cache
+from definitions.lazy_imports import lazy_import
+from definitions.shared_store import STORE_DIR, load_array
+
+spatial = lazy_import('scipy.spatial')
+
+# ===== RESULT PYRAMIDS ======================================================================
+# Lower resolution versions of the result maps, for the fsaverage6 / fsaverage5 displays. The fsaverage
+# meshes are nested (the first vertices of fsaverage are those of fsaverage6 and fsaverage5): each
+# fsaverage vertex is assigned to the nearest vertex of the lower resolution on the sphere, and the
+# values of the vertices assigned to the same (parent) vertex are aggregated:
+#   est  mean of the betas (of the children in a cluster only, for parents in a cluster)
+#   p    smallest p-value (largest -log10(p))
+#   ocn  cluster label shared by most children, when at least half of them are in a cluster
+# The maps of a model are stored in one compressed file, rebuilt when its source maps change:
+#   <artifact_root>/pyramids/<group>/<model>.npz     <measure>.<hemi>.<kind>.<resolution> arrays
+
+INDEX_NAME = 'pyramids'
+FORMAT_VERSION = 2
+
+LEVELS = {'fsaverage6': 40962, 'fsaverage5': 10242}
+KINDS = ['est', 'p', 'ocn']
+MESH_RETRY_SECONDS = 60  # wait before trying to fetch the fsaverage mesh again
+
+_signatures = {}  # pyramid file -> (file stamp, stored signature)
+_signatures_lock = threading.Lock()
+_mesh_failed_at = None  # last time the fsaverage mesh could not be fetched (monotonic clock)
+
+
+class MeshUnavailable(RuntimeError):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def parent_vertices(hemi, resol):
+    # Parent (nearest lower resolution vertex on the sphere) of each fsaverage vertex, stored in the shared store
+    path = os.path.join(STORE_DIR, f'pyramid_parents.{hemi}.{resol}.npy')
+    if not os.path.exists(path):
+        try:
+            coords = np.asarray(fetch_surface('fsaverage')[0][f'sphere_{hemi}'][0], dtype=float)
+        except Exception as e:  # e.g. mesh not downloaded and no connection
+            raise MeshUnavailable(f'fsaverage sphere not available: {e}') from e
+
+        n_nodes = LEVELS[resol]
+        parents = spatial.cKDTree(coords[:n_nodes]).query(coords)[1].astype(np.uint32)
+        parents[:n_nodes] = np.arange(n_nodes)  # the vertices of the lower resolution are their own parent
+
+        os.makedirs(STORE_DIR, exist_ok=True)
+        tmp = f'{path[:-len(".npy")]}.{os.getpid()}.tmp.npy'
+        np.save(tmp, parents)
+        os.replace(tmp, path)
+
+    return np.load(path, mmap_mode='r')
+
+
+@functools.lru_cache(maxsize=None)
+def _groups(hemi, resol):
+    # Children sorted by parent, and where the children of each parent start
+    parents = parent_vertices(hemi, resol)
+    order = np.argsort(parents, kind='stable')
+    starts = np.searchsorted(parents[order], np.arange(LEVELS[resol]))
+    return order, starts, np.bincount(parents, minlength=LEVELS[resol])
+
+
+def aggregate(values, hemi, resol, kind, clusters=None):
+    # fsaverage map -> map at a lower resolution (see above for the aggregation of each kind).
+    # clusters: fsaverage cluster map, to average the betas of the parents in a cluster over the cluster only
+    order, starts, counts = _groups(hemi, resol)
+    values = np.asarray(values)[order]
+
+    if kind == 'est':
+        valid = ~np.isnan(values)
+        if clusters is not None:
+            # Children outside the cluster would pull the mean out of the range of the cluster betas
+            parent_in_cluster = np.repeat(aggregate(clusters, hemi, resol, 'ocn') > 0, counts)
+            valid &= (np.asarray(clusters)[order] > 0) | ~parent_in_cluster
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.add.reduceat(np.where(valid, values, 0), starts) / np.add.reduceat(valid, starts)
+    if kind == 'p':
+        return np.fmax.reduceat(values, starts)
+
+    labels = np.nan_to_num(values).astype(np.int64)
+    in_cluster = labels > 0
+    parents = np.repeat(np.arange(len(starts)), counts)[in_cluster]
+
+    # Most frequent label among the children of each parent
+    n_labels = labels.max() + 1
+    pairs, pair_counts = np.unique(parents * n_labels + labels[in_cluster], return_counts=True)
+    pair_parents, pair_labels = np.divmod(pairs, n_labels)
+    first = np.lexsort((-pair_counts, pair_parents))
+    pair_parents, pair_labels = pair_parents[first], pair_labels[first]
+    first = np.diff(pair_parents, prepend=-1) != 0
+
+    aggregated = np.zeros(len(starts), dtype=np.int64)
+    aggregated[pair_parents[first]] = pair_labels[first]
+    aggregated[np.add.reduceat(in_cluster, starts) * 2 < counts] = 0  # less than half of the children in a cluster
+    return aggregated
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def pyramid_path(resdir, group, model):
+    os.makedirs(os.path.join(artifact_dir(resdir, INDEX_NAME), group), exist_ok=True)
+    return os.path.join(artifact_dir(resdir, INDEX_NAME), group, f'{model}.npz')
+
+
+def _signature(resdir, group, model):
+    sources = {}
+    for measure in model_measures(resdir, group, model):
+        for hemi in ['left', 'right']:
+            for kind in KINDS:
+                st = os.stat(result_map_path(resdir, group, model, measure, hemi, kind))
+                sources[f'{measure}.{hemi}.{kind}'] = [st.st_mtime_ns, st.st_size]
+    return {'format': FORMAT_VERSION, 'levels': list(LEVELS), 'sources': sources}
+
+
+def _stored_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    with _signatures_lock:
+        cached = _signatures.get(path)
+        if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+            return cached[1]
+
+    with np.load(path) as npz:
+        signature = json.loads(str(npz['signature']))
+    with _signatures_lock:
+        _signatures[path] = ((st.st_mtime_ns, st.st_size), signature)
+    return signature
+
+
+@timed('build_pyramid')
+def build_pyramid(resdir, group, model, signature):
+    arrays = {'signature': np.array(json.dumps(signature))}
+    for measure in model_measures(resdir, group, model):
+        for hemi in ['left', 'right']:
+            maps = {kind: read_surface_map(result_map_path(resdir, group, model, measure, hemi, kind)) for kind in KINDS}
+            for kind, values in maps.items():
+                for resol in LEVELS:  # same type as the fsaverage maps
+                    arrays[f'{measure}.{hemi}.{kind}.{resol}'] = \
+                        aggregate(values, hemi, resol, kind, clusters=maps['ocn']).astype(values.dtype)
+
+    path = pyramid_path(resdir, group, model)
+    tmp = f'{path[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(tmp, **arrays)
+    os.replace(tmp, path)
+    return path
+
+
+def ensure_pyramid(resdir, group, model):
+    # Path of the (up to date) pyramid of a model, built if needed
+    path = pyramid_path(resdir, group, model)
+    signature = _signature(resdir, group, model)
+    if _stored_signature(path) == signature:
+        record_cache('pyramid', hit=True)
+        return path
+
+    record_cache('pyramid', hit=False)
+    with open(f'{path[:-len(".npz")]}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # another worker may be building the same pyramid
+        if _stored_signature(path) != signature:
+            build_pyramid(resdir, group, model, signature)
+    return path
+
+
+def _read_member(path, key):
+    with np.load(path) as npz:
+        return npz[key]
+
+
+def pyramid_map(resdir, group, model, measure, hemi, kind, resol):
+    # Map of a model at a lower resolution, shared by all workers (see shared_store.py). Without the fsaverage
+    # mesh (offline), the map is truncated to the vertices of the lower resolution instead, and the mesh is
+    # fetched again after MESH_RETRY_SECONDS
+    global _mesh_failed_at
+    path = None
+    if _mesh_failed_at is None or time.monotonic() - _mesh_failed_at > MESH_RETRY_SECONDS:
+        try:
+            path = ensure_pyramid(resdir, group, model)
+            _mesh_failed_at = None
+        except MeshUnavailable as e:
+            print(f'Result pyramids unavailable, lower resolutions show the fsaverage values of their vertices '
+                  f'(next attempt in {MESH_RETRY_SECONDS} s): {e}')
+            _mesh_failed_at = time.monotonic()
+    if path is None:
+        return read_surface_map(result_map_path(resdir, group, model, measure, hemi, kind))[:LEVELS[resol]]
+
+    key = f'{measure}.{hemi}.{kind}.{resol}'
+    return load_array(path, functools.partial(_read_member, key=key), part=key)
+
+
+def ensure_pyramids(resdir, max_workers=None):
+    # Build the pyramids of all the models of a tree (in a process pool)
+    for hemi in ['left', 'right']:
+        for resol in LEVELS:
+            parent_vertices(hemi, resol)
+
+    models = sorted({(group, model) for group, model, _ in list_result_maps(resdir)})
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(ensure_pyramid, [resdir] * len(models), *zip(*models)))
+
+
+if __name__ == '__main__':
+    resdir = sys.argv[1] if len(sys.argv) > 1 else './results'
+    print(f'Pyramids of {len(ensure_pyramids(resdir))} models in {artifact_dir(resdir, INDEX_NAME)}')
@@ -0,0 +1,151 @@
+import os
+import asyncio
+import threading
+
+from shiny import reactive
+from watchfiles import awatch
+
+from definitions.backend_calculations import detect_models, model_measures, artifact_root
+from definitions.instrumentation import timed
+from definitions.model_search import INDEX_NAME as SEARCH_INDEX_NAME, ensure_search_index
+from definitions.shared_store import forget_views
+from definitions.spin_test import forget_results
+from definitions.vertex_index import INDEX_NAME, ensure_vertex_index
+
+# ===== RESULT WATCHER =======================================================================
+# New verywise runs dropped into <resdir>/<group>/<model>/ while the app is running are picked up by
+# a filesystem watcher (one per results folder and process, in the event loop of the server). Only
+# the models whose files changed are rescanned: their cached maps and spin tests are dropped, the
+# vertex index columns (and the search tables built from them) are updated and the catalog version is
+# bumped, which the open sessions poll to refresh their dropdowns.
+
+POLL_SECONDS = 2
+RESULT_SUFFIXES = ('.mgh', '.annot')
+
+_catalogs = {}  # results folder -> {group: {model: [measures]}}
+_watchers = {}  # results folder -> watcher task
+_version = 0
+_lock = threading.Lock()
+
+
+def _folder(resdir):
+    return os.path.realpath(resdir)
+
+
+def _scan(resdir):
+    return {group: {model: model_measures(resdir, group, model) for model in models}
+            for group, models in detect_models(resdir).items()}
+
+
+def model_catalog(resdir):
+    # {group: {model: [measures]}}, the folder is only scanned in full the first time
+    folder = _folder(resdir)
+    with _lock:
+        if folder not in _catalogs:
+            _catalogs[folder] = _scan(folder)
+        return _catalogs[folder]
+
+
+def catalog_models(resdir):
+    # Same as detect_models, from the catalog
+    return {group: list(models) for group, models in model_catalog(resdir).items()}
+
+
+def catalog_maps(resdir):
+    # Same as list_result_maps, from the catalog
+    return [(group, model, measure) for group, models in model_catalog(resdir).items()
+            for model, measures in models.items() for measure in measures]
+
+
+def catalog_version():
+    return _version
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def affected_models(resdir, paths):
+    # (group, model) of the result files, model folders and group folders among the changed paths
+    folder = _folder(resdir)
+    catalog = model_catalog(folder)
+
+    models = set()
+    for path in paths:
+        parts = os.path.relpath(path, folder).split(os.sep)
+        if parts[0] == '..' or any(p.startswith('.') for p in parts):  # hidden files, derived artifacts
+            continue
+
+        if len(parts) == 1:  # group folder added or removed
+            group = parts[0]
+            current = detect_models(folder).get(group, []) if os.path.isdir(os.path.join(folder, group)) else []
+            models |= {(group, model) for model in set(current) | set(catalog.get(group, {}))}
+        elif len(parts) == 2 or (len(parts) == 3 and parts[2].endswith(RESULT_SUFFIXES)):
+            models.add((parts[0], parts[1]))
+
+    return models
+
+
+@timed('apply_result_changes')
+def apply_changes(resdir, paths):
+    # Update the catalog, caches and derived artifacts of the models touched by the changed paths
+    global _version
+
+    folder = _folder(resdir)
+    models = affected_models(folder, paths)
+    if not models:
+        return models
+
+    forget_views(paths)
+    forget_results(folder, models)
+
+    with _lock:
+        catalog = _catalogs[folder]
+        for group, model in sorted(models):
+            if os.path.isdir(os.path.join(folder, group, model)):
+                catalog.setdefault(group, {})[model] = model_measures(folder, group, model)
+            else:
+                catalog.get(group, {}).pop(model, None)
+                if group in catalog and not catalog[group] and not os.path.isdir(os.path.join(folder, group)):
+                    del catalog[group]
+        maps = [(group, model, measure) for group, ms in catalog.items()
+                for model, measures in ms.items() for measure in measures]
+        _version += 1
+
+    # The vertex and search indexes are only kept up to date once they exist (built on the first lookup / search)
+    if os.path.exists(os.path.join(artifact_root(folder), INDEX_NAME, 'catalog.json')):
+        vertex_catalog = ensure_vertex_index(folder, maps=maps, changed=models)
+        if os.path.exists(os.path.join(artifact_root(folder), SEARCH_INDEX_NAME, 'catalog.json')):
+            ensure_search_index(folder, vertex_catalog)
+
+    return models
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+async def _watch(folder):
+    async for changes in awatch(folder):
+        try:
+            models = await asyncio.to_thread(apply_changes, folder, [path for _, path in changes])
+        except Exception as e:  # e.g. files still being copied
+            print(f'Could not update {folder}: {e}')
+            continue
+        if models:
+            print(f'Updated {", ".join(f"{g}/{m}" for g, m in sorted(models))} in {folder}')
+
+
+def watch_results(resdir):
+    # Start watching a results folder (once per process). Must be called from the event loop
+    folder = _folder(resdir)
+    if folder in _watchers or not os.path.isdir(folder):
+        return
+
+    model_catalog(folder)
+    _watchers[folder] = asyncio.get_running_loop().create_task(_watch(folder))
+
+
+def catalog_updates():
+    # Reactive value that changes whenever a watcher updated a catalog (to be created within a session)
+    @reactive.poll(catalog_version, POLL_SECONDS)
+    def version():
+        return catalog_version()
+
+    return version
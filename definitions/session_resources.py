@@ -0,0 +1,218 @@
+import os
+import sys
+import mmap
+import time
+import threading
+
+import numpy as np
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from definitions.instrumentation import SESSION_BYTES, SESSIONS_OPEN, SESSION_RELEASES, record_cache
+
+# ===== SESSION RESOURCES ====================================================================
+# The heavy reactive calcs of a session (result maps, legends, conjunctions) do not keep their value
+# themselves: they return a handle owned by this (per-process) manager, which estimates the memory
+# each value holds. Values are released when their session has been idle for BRAINMAPP_SESSION_IDLE_MINUTES
+# and, least recently used first across sessions, when all sessions together hold more than
+# BRAINMAPP_SESSION_MEMORY_MB. A released value is recomputed from the inputs it was first computed
+# with (the maps and figures come from the shared caches) the next time an output needs it, without
+# invalidating anything. The estimates are exported to /metrics and, per session (anonymously), to /sessions
+# when BRAINMAPP_SESSION_REPORT is set.
+
+IDLE_SECONDS = float(os.environ.get('BRAINMAPP_SESSION_IDLE_MINUTES', 15)) * 60
+MAX_SESSION_BYTES = int(os.environ.get('BRAINMAPP_SESSION_MEMORY_MB', 512)) * 2**20
+SWEEP_SECONDS = 30
+SESSION_REPORT = os.environ.get('BRAINMAPP_SESSION_REPORT', '') not in ('', '0')  # serve /sessions
+
+_RELEASED = object()
+
+_sessions = {}  # session id -> {calc name: HeldValue}
+_calc_names = set()  # labels of the memory gauge
+_lock = threading.RLock()
+_sweeper = None
+
+
+def _shared(a):
+    # Views of the shared store (memory-mapped) are not held by the session
+    while isinstance(a, np.ndarray):
+        a = a.base
+    return isinstance(a, mmap.mmap)
+
+
+def _figure_bytes(fig, seen):
+    # Data of the artists, plus the pixel buffer of the canvas once it was drawn
+    total = sum(estimate_bytes(v, seen) for artist in fig.findobj() for v in vars(artist).values()
+                if isinstance(v, np.ndarray) or type(v).__name__ == 'Path')
+    renderer = getattr(fig.canvas, 'renderer', None)
+    if renderer is not None:
+        total += int(renderer.width * renderer.height * 4)
+    return total
+
+
+def estimate_bytes(obj, seen=None):
+    # Approximate memory held by a value (arrays, data frames, figures and the containers holding them)
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        return 0 if _shared(obj) else obj.nbytes
+    if type(obj).__name__ == 'Path':  # matplotlib path
+        return estimate_bytes(obj.vertices, seen) + estimate_bytes(obj.codes, seen)
+    if type(obj).__name__ == 'Figure':
+        return _figure_bytes(obj, seen)
+    if hasattr(obj, 'memory_usage') and hasattr(obj, 'columns'):  # pandas data frame
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_bytes(k, seen) + estimate_bytes(v, seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(estimate_bytes(v, seen) for v in obj)
+    return sys.getsizeof(obj)
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class HeldValue:
+    # Value of a reactive calc, owned by the manager: value() recomputes it if it was released
+
+    def __init__(self, session_id, name, compute):
+        self.session_id = session_id
+        self.name = name
+        self.compute = compute
+        self.nbytes = 0
+        self.last_used = time.monotonic()
+        self._value = _RELEASED
+
+    @property
+    def released(self):
+        return self._value is _RELEASED
+
+    def value(self):
+        with _lock:
+            value = self._value
+            self.last_used = time.monotonic()
+        record_cache('session_value', hit=value is not _RELEASED)
+        if value is not _RELEASED:
+            return value
+
+        value = self.compute()
+        nbytes = estimate_bytes(value)
+        with _lock:
+            if _sessions.get(self.session_id, {}).get(self.name) is self:  # not replaced or ended in the meantime
+                self._value, self.nbytes = value, nbytes
+            _enforce_ceiling(keep=self)
+            _update_gauges()
+        return value
+
+    def release(self):
+        # Called with the lock held
+        self._value, self.nbytes = _RELEASED, 0
+
+
+def hold(session, name, compute):
+    # Handle on compute() (without arguments, the inputs should be read beforehand), computed right away.
+    # Replaces the previous value of the same calc in the session
+    session_id = session.id
+    name = session.ns(name)
+
+    with _lock:
+        if session_id not in _sessions:
+            _sessions[session_id] = {}
+            session.on_ended(lambda: forget_session(session_id))
+            _start_sweeper()
+        previous = _sessions[session_id].get(name)
+        if previous is not None:
+            previous.release()
+        held = _sessions[session_id][name] = HeldValue(session_id, name, compute)
+
+    held.value()
+    return held
+
+
+def forget_session(session_id):
+    with _lock:
+        for held in _sessions.pop(session_id, {}).values():
+            held.release()
+        _update_gauges()
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _held_values():
+    return [held for values in _sessions.values() for held in values.values()]
+
+
+def _update_gauges():
+    totals = dict.fromkeys(_calc_names, 0)
+    for held in _held_values():
+        totals[held.name] = totals.get(held.name, 0) + held.nbytes
+    for name, total in totals.items():
+        SESSION_BYTES.labels(name).set(total)
+    _calc_names.update(totals)
+    SESSIONS_OPEN.set(len(_sessions))
+
+
+def _enforce_ceiling(keep=None):
+    # Release the least recently used values (of any session) until the total is below the ceiling
+    held_values = [h for h in _held_values() if not h.released]
+    total = sum(h.nbytes for h in held_values)
+    for held in sorted(held_values, key=lambda h: h.last_used):
+        if total <= MAX_SESSION_BYTES:
+            break
+        if held is keep:
+            continue
+        total -= held.nbytes
+        held.release()
+        SESSION_RELEASES.labels('memory').inc()
+
+
+def release_idle(now=None):
+    # Release all the values of the sessions that did not use any of them for IDLE_SECONDS
+    now = time.monotonic() if now is None else now
+    with _lock:
+        for values in _sessions.values():
+            if values and now - max(h.last_used for h in values.values()) > IDLE_SECONDS:
+                for held in values.values():
+                    if not held.released:
+                        held.release()
+                        SESSION_RELEASES.labels('idle').inc()
+        _update_gauges()
+
+
+def _sweep():
+    while True:
+        time.sleep(SWEEP_SECONDS)
+        release_idle()
+
+
+def _start_sweeper():
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = threading.Thread(target=_sweep, name='session-sweeper', daemon=True)
+        _sweeper.start()
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def session_report():
+    now = time.monotonic()
+    with _lock:
+        sessions = [{'idle_seconds': round(now - max((h.last_used for h in values.values()), default=now), 1),
+                     'bytes': sum(h.nbytes for h in values.values()),
+                     'calcs': {h.name: {'bytes': h.nbytes, 'released': h.released} for h in values.values()}}
+                    for values in _sessions.values()]
+
+    return {'pid': os.getpid(),
+            'total_bytes': sum(s['bytes'] for s in sessions),
+            'limit_bytes': MAX_SESSION_BYTES,
+            'idle_seconds': IDLE_SECONDS,
+            'sessions': sorted(sessions, key=lambda s: -s['bytes'])}
+
+
+async def _serve_report(request):
+    return JSONResponse(session_report())
+
+
+session_routes = [Route('/sessions', _serve_report)] if SESSION_REPORT else []
@@ -0,0 +1,186 @@
+import os
+import sys
+import fcntl
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from collections.abc import Mapping
+
+import numpy as np
+
+from definitions.instrumentation import timed, record_cache
+from definitions.lazy_imports import lazy_import
+
+nb = lazy_import('nibabel')
+surface = lazy_import('nilearn.surface')
+
+# ===== SHARED ARRAY STORE ===================================================================
+# Decoded meshes and result maps are written once as .npy files in a shared directory (tmpfs
+# when available) and every worker maps them read-only: the data lives once in the page cache
+# regardless of the number of uvicorn workers.
+
+STORE_DIR = os.environ.get('BRAINMAPP_STORE_DIR',
+                           '/dev/shm/brainmapp' if os.path.isdir('/dev/shm') else
+                           os.path.join(tempfile.gettempdir(), 'brainmapp'))
+
+_views = {}
+_views_lock = threading.Lock()
+
+
+def _entry_name(path, part, stamp):
+    source = hashlib.blake2b(f'{os.path.abspath(path)}#{part}'.encode(), digest_size=10).hexdigest()
+    version = hashlib.blake2b(f'{stamp[0]}:{stamp[1]}'.encode(), digest_size=6).hexdigest()
+    return source, f'{source}-{version}.npy'
+
+
+def _write_entry(entry, source, data):
+    tmp = f'{entry}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, np.ascontiguousarray(data))
+    os.replace(tmp, entry)
+
+    # Remove the versions of the same source that are now outdated (attached views stay valid)
+    for f in os.listdir(STORE_DIR):
+        if f.startswith(f'{source}-') and f.endswith('.npy') and os.path.join(STORE_DIR, f) != entry:
+            try:
+                os.remove(os.path.join(STORE_DIR, f))
+            except FileNotFoundError:
+                pass
+
+
+def load_array(path, decode, part=''):
+    # Zero-copy, read-only view of `decode(path)`, decoded only once across all processes
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    with _views_lock:
+        cached = _views.get((path, part))
+        if cached is not None and cached[0] == stamp:
+            record_cache('surface_map', hit=True)
+            return cached[1]
+
+    record_cache('surface_map', hit=False)
+
+    source, name = _entry_name(path, part, stamp)
+    entry = os.path.join(STORE_DIR, name)
+
+    if not os.path.exists(entry):
+        os.makedirs(STORE_DIR, exist_ok=True)
+        with open(os.path.join(STORE_DIR, 'decode.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # another process may be decoding the same file
+            if not os.path.exists(entry):
+                record_cache('shared_store', hit=False)
+                _write_entry(entry, source, decode(path))
+    else:
+        record_cache('shared_store', hit=True)
+
+    view = np.load(entry, mmap_mode='r')
+
+    with _views_lock:
+        _views[(path, part)] = (stamp, view)
+
+    return view
+
+
+def forget_views(paths):
+    # Drop the attached views of the given source files (they are re-attached on next use)
+    paths = {os.path.realpath(p) for p in paths}
+    with _views_lock:
+        for key in [k for k in _views if os.path.realpath(k[0]) in paths]:
+            del _views[key]
+
+# ===== DECODERS =============================================================================
+
+
+def _native(data):
+    data = np.asarray(data)
+    return data.astype(data.dtype.newbyteorder('='), copy=False)
+
+
+@timed('disk_load')
+def decode_mgh(path):
+    return _native(nb.load(path).dataobj).ravel()
+
+
+def decode_mesh_coordinates(path):
+    return _native(surface.load_surf_mesh(path).coordinates)
+
+
+def decode_mesh_faces(path):
+    return _native(surface.load_surf_mesh(path).faces)
+
+
+def decode_surf_data(path):
+    return _native(surface.load_surf_data(path))
+
+
+class SurfaceViews(Mapping):
+    # Same keys as the nilearn fsaverage bunch, with shared (coordinates, faces) meshes and
+    # per-vertex background maps instead of file paths
+
+    def __init__(self, paths):
+        self._paths = {k: v for k, v in paths.items() if k != 'description'}
+
+    def __getitem__(self, key):
+        path = self._paths[key]
+        if key.split('_')[0] in ('sulc', 'curv', 'thick', 'area'):
+            return load_array(path, decode_surf_data)
+        return (load_array(path, decode_mesh_coordinates, part='coordinates'),
+                load_array(path, decode_mesh_faces, part='faces'))
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+# ===== LOADER PROCESS =======================================================================
+
+
+def populate_store(resdir, resolutions=('fsaverage5', 'fsaverage6', 'fsaverage')):
+    # Decode all meshes and result maps into the store. Only one process does the work: the
+    # others return immediately and attach to the entries as they become available
+    from definitions.backend_calculations import fetch_surface, list_result_maps, result_map_path
+
+    os.makedirs(STORE_DIR, exist_ok=True)
+    with open(os.path.join(STORE_DIR, 'populate.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        for resol in resolutions:
+            try:
+                meshes = fetch_surface(resol)[0]
+                for key in meshes:
+                    meshes[key]
+            except Exception as e:  # e.g. mesh not downloaded and no connection
+                print(f'Could not load {resol} meshes into the shared store: {e}')
+
+        for group, model, measure in list_result_maps(resdir):
+            for hemi in ['left', 'right']:
+                for kind in ['est', 'p', 'ocn']:
+                    load_array(result_map_path(resdir, group, model, measure, hemi, kind), decode_mgh)
+
+        # Lower resolution maps (see pyramids.py), built here rather than on the first request
+        from definitions.pyramids import MeshUnavailable, ensure_pyramid
+        try:
+            for group, model in sorted({(group, model) for group, model, _ in list_result_maps(resdir)}):
+                ensure_pyramid(resdir, group, model)
+        except MeshUnavailable as e:
+            print(f'Could not build the result pyramids: {e}')
+
+        return True
+
+
+def start_loader(resdir):
+    # Populate the store from a separate process, so the workers keep serving in the meantime
+    process = multiprocessing.get_context('spawn').Process(target=populate_store, args=(resdir,),
+                                                           name='brainmapp-store-loader', daemon=True)
+    process.start()
+    return process
+
+
+if __name__ == '__main__':
+    populate_store(sys.argv[1] if len(sys.argv) > 1 else './results')
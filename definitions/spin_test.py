@@ -0,0 +1,146 @@
+import os
+import functools
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from definitions.backend_calculations import fetch_surface, result_map_path, read_result_map
+from definitions.instrumentation import timed, record_cache
+from definitions.lazy_imports import lazy_import
+from definitions.shared_store import STORE_DIR
+
+spatial = lazy_import('scipy.spatial')
+
+# ===== SPIN PERMUTATIONS ====================================================================
+# Null model for the overlap of two cluster maps that preserves cluster size and spatial smoothness:
+# the first map is randomly rotated on the fsaverage sphere (mirrored rotations for the right
+# hemisphere) and its overlap with the second map is counted again.
+# The vertex reassignment of each rotation only depends on the mesh, so it is computed once per
+# resolution (in a process pool) and stored as a (rotations x vertices) index matrix in the shared
+# store. Testing a pair of maps is then a single gather over that matrix.
+
+N_PERMUTATIONS = 1000
+BATCH_SIZE = 50  # rotations per pool task
+RESULTS_CACHE_SIZE = 256
+
+MIRROR = np.diag([-1., 1., 1.])  # left <-> right hemisphere reflection
+
+_results = OrderedDict()
+_results_lock = threading.Lock()
+_spins_lock = threading.Lock()
+
+
+def random_rotations(n, seed=0):
+    # Uniformly distributed 3D rotation matrices (QR decomposition of gaussian matrices)
+    rng = np.random.default_rng(seed)
+    q, r = np.linalg.qr(rng.standard_normal((n, 3, 3)))
+    q = q * np.sign(np.diagonal(r, axis1=1, axis2=2))[:, np.newaxis, :]
+    q[np.linalg.det(q) < 0, :, 0] *= -1
+    return q
+
+
+@functools.lru_cache(maxsize=None)
+def _sphere_tree(resol, hemi):
+    coords = np.asarray(fetch_surface(resol)[0][f'sphere_{hemi}'][0], dtype=float)
+    return coords, spatial.cKDTree(coords)
+
+
+def _spin_batch(path, resol, hemi, start, rotations):
+    coords, tree = _sphere_tree(resol, hemi)
+    rotated = (coords @ rotations.transpose(0, 2, 1)).reshape(-1, 3)
+
+    out = np.load(path, mmap_mode='r+')
+    out[start:start + len(rotations)] = tree.query(rotated)[1].reshape(len(rotations), -1)
+    out.flush()
+
+
+@timed('spin_indices')
+def spin_indices(resol, hemi, n_perm=N_PERMUTATIONS, seed=0, max_workers=None):
+    # (n_perm x n_vertices) matrix: vertex that each vertex lands on after each rotation
+    path = os.path.join(STORE_DIR, f'spins.{resol}.{hemi}.{n_perm}.{seed}.npy')
+
+    with _spins_lock:
+        if not os.path.exists(path):
+            record_cache('spin_indices', hit=False)
+
+            rotations = random_rotations(n_perm, seed)
+            if hemi == 'right':
+                rotations = MIRROR @ rotations @ MIRROR
+
+            n_vertices = fetch_surface(resol)[1]
+            dtype = np.uint16 if n_vertices <= np.iinfo(np.uint16).max else np.uint32
+
+            os.makedirs(STORE_DIR, exist_ok=True)
+            tmp = f'{path[:-len(".npy")]}.{os.getpid()}.tmp.npy'
+            np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=(n_perm, n_vertices)).flush()
+
+            # Spawned workers: forking the threaded server could copy locks held by its other threads
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                tasks = [pool.submit(_spin_batch, tmp, resol, hemi, start, rotations[start:start + BATCH_SIZE])
+                         for start in range(0, n_perm, BATCH_SIZE)]
+                for task in tasks:
+                    task.result()
+
+            os.replace(tmp, path)
+        else:
+            record_cache('spin_indices', hit=True)
+
+    return np.load(path, mmap_mode='r')
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def cluster_mask(resdir, group, model, measure, hemi, resol):
+    return read_result_map(resdir, group, model, measure, hemi, 'ocn', resol) > 0
+
+
+def forget_results(resdir, models):
+    # Drop the cached tests that involve any of the given (group, model)
+    resdir, models = os.path.realpath(resdir), {tuple(m) for m in models}
+    with _results_lock:
+        for key in [k for k in _results if k[0] == resdir and {k[1][:2], k[2][:2]} & models]:
+            del _results[key]
+
+
+@timed('spin_test')
+def spin_overlap_test(resdir, selection1, selection2, resol='fsaverage6', n_perm=N_PERMUTATIONS, seed=0):
+    # selection: (group, model, measure). Returns the observed overlap (in vertices), the overlaps of
+    # the rotated maps and the spin p-value
+    key = (os.path.realpath(resdir), tuple(selection1), tuple(selection2), resol, n_perm, seed,
+           tuple(os.stat(result_map_path(resdir, *sel, hemi, 'ocn')).st_mtime_ns
+                 for sel in (selection1, selection2) for hemi in ['left', 'right']))
+
+    with _results_lock:
+        if key in _results:
+            _results.move_to_end(key)
+            record_cache('spin_test', hit=True)
+            return _results[key]
+    record_cache('spin_test', hit=False)
+
+    observed = 0
+    null = np.zeros(n_perm, dtype=np.int64)
+
+    for hemi in ['left', 'right']:
+        mask1 = cluster_mask(resdir, *selection1, hemi, resol)
+        mask2 = cluster_mask(resdir, *selection2, hemi, resol)
+
+        observed += int(np.count_nonzero(mask1 & mask2))
+        if mask1.any() and mask2.any():
+            # Rotated map 1 at the vertices of map 2, for all rotations at once
+            null += np.count_nonzero(mask1[spin_indices(resol, hemi, n_perm, seed)[:, mask2]], axis=1)
+
+    result = {'observed': observed,
+              'null': null,
+              'p_spin': (1 + np.count_nonzero(null >= observed)) / (1 + n_perm),
+              'n_perm': n_perm,
+              'resolution': resol}
+
+    with _results_lock:
+        _results[key] = result
+        while len(_results) > RESULTS_CACHE_SIZE:
+            _results.popitem(last=False)
+
+    return result
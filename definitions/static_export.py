@@ -0,0 +1,217 @@
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import warnings
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from definitions.backend_calculations import fetch_surface, extract_results, list_result_maps, result_map_path, \
+    read_result_map
+from definitions.lazy_imports import lazy_import
+from definitions.pyramids import LEVELS, MeshUnavailable, ensure_pyramid, parent_vertices
+import definitions.layout_styles as styles
+
+mpl = lazy_import('matplotlib')
+datasets = lazy_import('nilearn.datasets')
+
+# ===== STATIC SITE EXPORT ===================================================================
+# Writes a results tree as a static website that can be browsed without Python:
+#   index.html                  viewer (plotly.js), loads everything below on demand
+#   manifest.json               resolutions, models, colormaps and asset locations
+#   assets/mesh/...             one gzipped mesh per resolution x surface x hemisphere
+#   assets/sulc/...             one gzipped background (sulcal depth) map per resolution x hemisphere
+#   assets/maps/...             one gzipped vertex data file per model x measure x resolution x hemisphere
+#   assets/plotly.min.js        plotly.js of the installed plotly package (no network needed)
+# The lower resolution maps come from the result pyramids (see pyramids.py). Asset names include a
+# signature of their source files, so unchanged assets are reused by the next export and the files
+# of removed / updated models are cleaned up.
+
+FORMAT_VERSION = 2
+
+VIEWER_TEMPLATE = os.path.join(os.path.dirname(__file__), 'static_viewer.html')
+PLOTLY_JS = os.path.join(os.path.dirname(importlib.util.find_spec('plotly').origin), 'package_data', 'plotly.min.js')
+
+COLORMAPS = ['hot_r', 'viridis', 'viridis_r', styles.CLUSTER_COLORMAP]
+
+
+def _signature(paths):
+    sig = hashlib.blake2b(f'v{FORMAT_VERSION}'.encode(), digest_size=6)
+    for path in paths:
+        st = os.stat(path)
+        sig.update(f'{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}'.encode())
+    return sig.hexdigest()
+
+
+def _write_asset(outdir, name, chunks):
+    # Deterministic gzip (no timestamp), written atomically
+    path = os.path.join(outdir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+        for chunk in chunks:
+            f.write(np.ascontiguousarray(chunk).tobytes())
+    os.replace(f'{path}.tmp', path)
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def pack_mesh(outdir, resol, surf, hemi):
+    # Layout: uint32 [n_vertices, n_faces] | float32 coordinates (n_vertices x 3) | uint32 faces (n_faces x 3)
+    source = datasets.fetch_surf_fsaverage(mesh=resol)[f'{surf}_{hemi}']
+    name = f'assets/mesh/{resol}.{surf}.{hemi}.{_signature([source])}.bin.gz'
+
+    if not os.path.exists(os.path.join(outdir, name)):
+        coords, faces = fetch_surface(resol)[0][f'{surf}_{hemi}']
+        _write_asset(outdir, name, [np.array([len(coords), len(faces)], dtype='<u4'),
+                                    coords.astype('<f4'), faces.astype('<u4')])
+    return name
+
+
+def pack_sulc(outdir, resol, hemi):
+    # Layout: uint8 sulcal depth, rescaled to 0-255
+    source = datasets.fetch_surf_fsaverage(mesh=resol)[f'sulc_{hemi}']
+    name = f'assets/sulc/{resol}.{hemi}.{_signature([source])}.bin.gz'
+
+    if not os.path.exists(os.path.join(outdir, name)):
+        sulc = np.asarray(fetch_surface(resol)[0][f'sulc_{hemi}'], dtype=float)
+        sulc = (sulc - sulc.min()) / (sulc.max() - sulc.min()) * 255
+        _write_asset(outdir, name, [np.round(sulc).astype('u1')])
+    return name
+
+
+def pack_model(outdir, resdir, group, model, measure, resolutions):
+    # Layout (per resolution and hemisphere, n = number of vertices): float16 betas (n) | uint16 cluster labels (n) |
+    # uint8 -log10(p) in steps of 0.1 (n)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        min_beta, max_beta, mean_beta, n_clusters, _, _, _ = extract_results(resdir, group, model, measure)
+
+    info = {'group': group, 'model': model, 'measure': measure,
+            'n_clusters': [int(n) for n in n_clusters],
+            'min_beta': None if np.isnan(min_beta) else float(min_beta),
+            'max_beta': None if np.isnan(max_beta) else float(max_beta),
+            'mean_beta': None if np.isnan(mean_beta) else float(mean_beta),
+            'files': {}}
+
+    for resol in resolutions:
+        info['files'][resol] = {}
+        for hemi in ['left', 'right']:
+            sources = [result_map_path(resdir, group, model, measure, hemi, kind) for kind in ['est', 'ocn', 'p']] \
+                if resol == 'fsaverage' else [ensure_pyramid(resdir, group, model)]
+            name = f'assets/maps/{group}/{model}/{measure}.{resol}.{hemi}.{_signature(sources)}.bin.gz'
+
+            if not os.path.exists(os.path.join(outdir, name)):
+                est, ocn, logp = [read_result_map(resdir, group, model, measure, hemi, kind, resol)
+                                  for kind in ['est', 'ocn', 'p']]
+                _write_asset(outdir, name, [est.astype('<f2'),
+                                            ocn.astype('<u2'),
+                                            np.round(np.clip(logp, 0, 25.5) * 10).astype('u1')])
+
+            info['files'][resol][hemi] = name
+
+    return info
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _colormap_tables():
+    # 256-entry RGB lookup tables, so the viewer uses the same colours as the app
+    return {name: (np.round(mpl.colormaps[name](np.linspace(0, 1, 256))[:, :3] * 255)).astype(int).tolist()
+            for name in COLORMAPS}
+
+
+def _available_resolutions(resolutions):
+    available = []
+    for resol in resolutions:
+        try:
+            datasets.fetch_surf_fsaverage(mesh=resol)
+        except Exception as e:  # e.g. mesh not downloaded and no connection
+            print(f'Skipping {resol}: {e}')
+            continue
+        if resol in LEVELS:
+            try:  # lower resolution maps are built from the fsaverage mesh
+                for hemi in ['left', 'right']:
+                    parent_vertices(hemi, resol)
+            except MeshUnavailable as e:
+                print(f'Skipping {resol} (no result pyramids): {e}')
+                continue
+        available.append(resol)
+    return available
+
+
+def _copy_plotly(outdir):
+    name = 'assets/plotly.min.js'
+    path = os.path.join(outdir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not os.path.exists(path) or os.path.getsize(path) != os.path.getsize(PLOTLY_JS):
+        shutil.copyfile(PLOTLY_JS, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+    return name
+
+
+def _remove_unused_assets(outdir, used):
+    for root, _, files in os.walk(os.path.join(outdir, 'assets')):
+        for f in files:
+            path = os.path.relpath(os.path.join(root, f), outdir)
+            if path not in used:
+                os.remove(os.path.join(outdir, path))
+
+
+def export_site(resdir, outdir, resolutions=('fsaverage5', 'fsaverage6', 'fsaverage'), surfaces=('pial', 'infl'),
+                max_workers=None):
+
+    resolutions = _available_resolutions(resolutions)
+    if not resolutions:
+        raise RuntimeError('None of the requested fsaverage meshes is available')
+
+    os.makedirs(outdir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        meshes = {(resol, surf, hemi): pool.submit(pack_mesh, outdir, resol, surf, hemi)
+                  for resol in resolutions for surf in surfaces for hemi in ['left', 'right']}
+        sulci = {(resol, hemi): pool.submit(pack_sulc, outdir, resol, hemi)
+                 for resol in resolutions for hemi in ['left', 'right']}
+        models = [pool.submit(pack_model, outdir, resdir, group, model, measure, resolutions)
+                  for group, model, measure in list_result_maps(resdir)]
+
+        manifest = {
+            'format': FORMAT_VERSION,
+            'resolutions': {resol: {'n_vertices': fetch_surface(resol)[1],
+                                    'sulc': {hemi: sulci[(resol, hemi)].result() for hemi in ['left', 'right']},
+                                    'surfaces': {surf: {hemi: meshes[(resol, surf, hemi)].result()
+                                                        for hemi in ['left', 'right']}
+                                                 for surf in surfaces}}
+                            for resol in resolutions},
+            'colormaps': _colormap_tables(),
+            'cluster_colormap': styles.CLUSTER_COLORMAP,
+            'models': [m.result() for m in models]}
+
+    used = {f for r in manifest['resolutions'].values() for f in r['sulc'].values()} | \
+           {f for r in manifest['resolutions'].values() for s in r['surfaces'].values() for f in s.values()} | \
+           {f for m in manifest['models'] for r in m['files'].values() for f in r.values()} | \
+           {_copy_plotly(outdir)}
+    _remove_unused_assets(outdir, used)
+
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    shutil.copyfile(VIEWER_TEMPLATE, os.path.join(outdir, 'index.html'))
+
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a results tree as a static website')
+    parser.add_argument('resdir', help='results directory (<group>/<model>/ maps)')
+    parser.add_argument('outdir', help='output directory of the website')
+    parser.add_argument('--resolutions', nargs='+', default=['fsaverage5', 'fsaverage6', 'fsaverage'])
+    parser.add_argument('--surfaces', nargs='+', default=['pial', 'infl'])
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    site = export_site(args.resdir, args.outdir, resolutions=args.resolutions, surfaces=args.surfaces,
+                       max_workers=args.workers)
+    print(f'Exported {len(site["models"])} maps to {args.outdir}')
@@ -1,13 +1,20 @@
 from shiny import Inputs, Outputs, Session, module, reactive, render, ui
 
-from shinywidgets import output_widget, render_plotly
-
 import io
+import os
 
 import definitions.layout_styles as styles
-from definitions.backend_calculations import detect_models, extract_results, compute_overlap
-from definitions.backend_dynamic_plots import plot_surfmap, plot_overlap
+from definitions.backend_calculations import extract_results, compute_overlap
+from definitions.backend_dynamic_plots import plot_surfmap
 from definitions.backend_static_plots import beta_colorbar_density_figure, clusterwise_means_figure, plot_brain_2d
+from definitions.figure_cache import cached_figures, map_hash, brain_view
+from definitions.instrumentation import profile_request, stage_timer
+from definitions.lazy_imports import lazy_import
+from definitions.result_watcher import watch_results, catalog_models, catalog_updates
+from definitions.session_resources import hold
+from definitions.vertex_index import vertex_table
+
+plt = lazy_import('matplotlib.pyplot')
 
 
 @module.ui
@@ -72,14 +79,18 @@ def single_result_ui():
         # Brain plots
         ui.layout_columns(
             ui.card('Left hemisphere',
-                    output_widget('brain_left'),
+                    ui.output_ui('brain_left'),
                     full_screen=True),  # expand icon appears when hovering over the card body
             ui.card('Right hemisphere',
-                    output_widget('brain_right'),
+                    ui.output_ui('brain_right'),
                     full_screen=True),
             ui.output_plot('color_legend'),
             col_widths=(4, 4, 4)
-        ))
+        ),
+        # Vertex lookup (click on a brain)
+        ui.card(ui.output_ui('vertex_info'),
+                ui.output_table('vertex_models'),
+                full_screen=True))
 
 @module.server
 def update_single_result(input: Inputs, output: Outputs, session: Session,
@@ -92,7 +103,8 @@ def update_single_result(input: Inputs, output: Outputs, session: Session,
     @render.ui
     @reactive.event(go)
     def pheno_ui():
-        phenotypes = list(detect_models(input_resdir()).keys())
+        watch_results(input_resdir())  # keep the choices up to date with the folder
+        phenotypes = list(catalog_models(input_resdir()).keys())
         return ui.input_selectize(
             id='select_pheno',
             label="Choose phenotype",
@@ -102,26 +114,39 @@ def update_single_result(input: Inputs, output: Outputs, session: Session,
     @render.ui
     def model_ui():
         pheno = input.select_pheno()
-        models = detect_models(input_resdir())[pheno]
+        models = catalog_models(input_resdir())[pheno]
         return ui.input_selectize(
             id='select_model',
             label='Choose model',
             choices=models,
             selected=models[0])  # start_model
 
-    @reactive.Calc
-    @reactive.event(input.update_button, ignore_none=True)
-    def single_result_output():
-        with ui.Progress(min=1, max=6) as p:
+    @reactive.Effect
+    @reactive.event(catalog_updates(), ignore_init=True)
+    def _update_choices():
+        # New or removed results in the folder: refresh the dropdowns, keeping the current selection
+        if 'select_pheno' not in input or 'select_model' not in input or not os.path.isdir(input_resdir()):
+            return
+        with reactive.isolate():
+            catalog = catalog_models(input_resdir())
+            pheno = input.select_pheno() if input.select_pheno() in catalog else next(iter(catalog), None)
+            models = catalog.get(pheno, [])
+            model = input.select_model() if input.select_model() in models else next(iter(models), None)
+
+            ui.update_selectize('select_pheno', choices=list(catalog), selected=pheno)
+            ui.update_selectize('select_model', choices=models, selected=model)
+
+    def single_result(resdir, group, model, measure, output, surf, resol):
+        with profile_request('single_result'), ui.Progress(min=1, max=6) as p:
 
             p.set(1, message="Loading results...")
 
             # Extract results
             min_beta, max_beta, mean_beta, n_clusters, sign_clusters, sign_betas, all_betas = extract_results(
-                resdir=input_resdir(),
-                group=input.select_pheno(),
-                model=input.select_model(),
-                measure=input.select_measure())
+                resdir=resdir,
+                group=group,
+                model=model,
+                measure=measure)
 
             p.set(2, message="Calculating maps...")
 
@@ -141,15 +166,22 @@ def update_single_result(input: Inputs, output: Outputs, session: Session,
 
                 p.set(3, message="Calculating maps...")
 
-                brains = plot_surfmap(
-                    min_beta, max_beta, n_clusters, sign_clusters, sign_betas,
-                    surf=input.select_surface(),
-                    resol=input.select_resolution(),
-                    output=input.select_output())
+                # Maps at the displayed resolution (see pyramids.py), colour range of the full resolution maps
+                brain_clusters, brain_betas = extract_results(resdir, group, model, measure, resol)[4:6]
+
+                # The key holds every input of plot_surfmap: the colour range and cluster colours come from the
+                # full resolution maps, not from the maps drawn
+                brains = cached_figures(
+                    ('surfmap', map_hash(brain_clusters['left'], brain_clusters['right'],
+                                         brain_betas['left'], brain_betas['right']),
+                     float(min_beta), float(max_beta), int(n_clusters[0]), int(n_clusters[1]), resol, surf, output),
+                    lambda: plot_surfmap(min_beta, max_beta, n_clusters, brain_clusters, brain_betas,
+                                         surf=surf, resol=resol, output=output),
+                    resol=resol)
 
                 p.set(4, message="Rendering brains...")
 
-                if input.select_output() == 'betas':
+                if output == 'betas':
                     legend_plot = beta_colorbar_density_figure(sign_betas, all_betas,
                                                              figsize=(4, 6),
                                                              colorblind=False,
@@ -164,24 +196,57 @@ def update_single_result(input: Inputs, output: Outputs, session: Session,
 
         return info, brains, legend_plot
 
+    @reactive.Calc
+    @reactive.event(input.update_button, ignore_none=True)
+    def single_result_output():
+        # The maps and figures are held by the session resource manager (released when the session is idle)
+        selection = dict(resdir=input_resdir(), group=input.select_pheno(), model=input.select_model(),
+                         measure=input.select_measure(), output=input.select_output(),
+                         surf=input.select_surface(), resol=input.select_resolution())
+        return hold(session, 'single_result', lambda: single_result(**selection))
+
     @render.text
     def info():
-        md_info = single_result_output()[0]
+        md_info = single_result_output().value()[0]
         return md_info
 
-    @render_plotly
+    clicked_vertex = reactive.Value(None)
+
+    @reactive.Effect
+    @reactive.event(input.click_left)
+    def _click_left():
+        clicked_vertex.set(('left', input.click_left()))
+
+    @reactive.Effect
+    @reactive.event(input.click_right)
+    def _click_right():
+        clicked_vertex.set(('right', input.click_right()))
+
+    @render.ui
     def brain_left():
-        brain = single_result_output()[1]
-        return brain['left']
+        return brain_view(single_result_output().value()[1]['left'], click_input=session.ns('click_left'))
 
-    @render_plotly
+    @render.ui
     def brain_right():
-        brain = single_result_output()[1]
-        return brain['right']
+        return brain_view(single_result_output().value()[1]['right'], click_input=session.ns('click_right'))
+
+    @render.text
+    def vertex_info():
+        if clicked_vertex() is None:
+            return ui.markdown('Click on a brain to see the results of every model at that vertex.')
+        hemi, vertex = clicked_vertex()
+        return ui.markdown(f'All models at vertex **{vertex}** ({hemi} hemisphere):')
+
+    @render.table
+    def vertex_models():
+        if clicked_vertex() is None:
+            return None
+        hemi, vertex = clicked_vertex()
+        return vertex_table(input_resdir(), hemi, vertex)
 
     @render.plot(alt="All observed beta values")
     def color_legend():
-        return single_result_output()[2]
+        return single_result_output().value()[2]
 
     @render.download(filename=f"Brainmapp_figure.png")
     def download_figure_button():
@@ -191,8 +256,9 @@ def update_single_result(input: Inputs, output: Outputs, session: Session,
                                  meas=input.select_measure(),
                                  resol=input.select_resolution(),
                                  title=None)
-        with io.BytesIO() as buf:
+        with io.BytesIO() as buf, stage_timer('png_export', input.select_resolution()):
             stat_fig.savefig(buf, format="png")
+            plt.close(stat_fig)  # not kept by pyplot once exported
             yield buf.getvalue()
 
     return input.select_pheno, input.select_model, input.select_measure
@@ -216,7 +282,12 @@ overlap_page = ui.div(
 
             ui.div(' ', style='padding-top: 80px'),
 
-            col_widths=(3, 3, 2),  # negative numbers for empty spaces
+            ui.div(ui.input_action_button(id='overlap_spin_button',
+                                          label='Spin test',
+                                          class_='btn btn-dark action-button'),
+                   style='padding-top: 30px'),
+
+            col_widths=(3, 3, 2, 2),  # negative numbers for empty spaces
             gap='30px',
             style=styles.SELECTION_PANE
         ),
@@ -225,13 +296,97 @@ overlap_page = ui.div(
             ui.output_ui('overlap_info'),
             style=styles.INFO_MESSAGE
         ),
+        ui.row(
+            ui.output_ui('overlap_spin_info'),
+            style=styles.INFO_MESSAGE
+        ),
         # Brain plots
         ui.layout_columns(
             ui.card('Left hemisphere',
-                    output_widget('overlap_brain_left'),
+                    ui.output_ui('overlap_brain_left'),
                     full_screen=True),  # expand icon appears when hovering over the card body
             ui.card('Right hemisphere',
-                    output_widget('overlap_brain_right'),
+                    ui.output_ui('overlap_brain_right'),
                     full_screen=True)
         ))
 
+# ------------------------------------------------------------------------------
+
+
+conjunction_page = ui.div(
+        # Selection pane
+        ui.layout_columns(
+            ui.input_selectize(
+                id='conj_select_models',
+                label='Models',
+                choices=[],
+                multiple=True),
+            ui.input_selectize(
+                id='conj_select_display',
+                label='Display',
+                choices={'frequency': 'Number of models', 'all': 'Significant in all', 'any': 'Significant in any'},
+                selected='frequency'),
+            ui.input_selectize(
+                id='conj_select_surface',
+                label='Surface type',
+                choices={'pial': 'Pial', 'infl': 'Inflated', 'flat': 'Flat'},
+                selected='pial'),
+            ui.input_selectize(
+                id='conj_select_resolution',
+                label='Resolution',
+                choices={'fsaverage': 'High (164k nodes)', 'fsaverage6': 'Medium (50k nodes)', 'fsaverage5': 'Low (10k modes)'},
+                selected='fsaverage6'),
+            ui.div(ui.input_action_button(id='conj_go_button',
+                                          label='GO',
+                                          class_='btn btn-dark action-button'),
+                   style='padding-top: 15px'),
+
+            col_widths=(4, 2, 2, 2, 1),  # negative numbers for empty spaces
+            gap='30px',
+            style=styles.SELECTION_PANE
+        ),
+        # Info
+        ui.row(
+            ui.output_ui('conj_info'),
+            style=styles.INFO_MESSAGE
+        ),
+        # Brain plots
+        ui.layout_columns(
+            ui.card('Left hemisphere',
+                    ui.output_ui('conj_brain_left'),
+                    full_screen=True),  # expand icon appears when hovering over the card body
+            ui.card('Right hemisphere',
+                    ui.output_ui('conj_brain_right'),
+                    full_screen=True)
+        ),
+        # Combinations (UpSet-style summary)
+        ui.card(ui.output_table('conj_combinations'),
+                full_screen=True))
+
+# ------------------------------------------------------------------------------
+
+
+search_page = ui.div(
+        # Selection pane
+        ui.layout_columns(
+            ui.input_text(
+                id='search_query',
+                label='Region',
+                placeholder='e.g. SCZ/SCZ/thickness:lh1 or lh:1200-1500,1731'),
+            ui.div(ui.input_action_button(id='search_button',
+                                          label='Search',
+                                          class_='btn btn-dark action-button'),
+                   style='padding-top: 15px'),
+
+            col_widths=(8, 2),  # negative numbers for empty spaces
+            gap='30px',
+            style=styles.SELECTION_PANE
+        ),
+        # Info
+        ui.row(
+            ui.output_ui('search_info'),
+            style=styles.INFO_MESSAGE
+        ),
+        # Ranked models
+        ui.card(ui.output_table('search_results'),
+                full_screen=True))
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import fcntl
+import threading
+
+import numpy as np
+
+from definitions.backend_calculations import list_result_maps, result_map_path, read_surface_map, artifact_dir
+from definitions.instrumentation import timed
+from definitions.lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+
+# ===== VERTEX-MAJOR INDEX ===================================================================
+# The per-model maps are transposed into one (vertices x models) matrix per hemisphere, measure and
+# map kind, so the values of all models at one vertex are a single contiguous row:
+#   <artifact_root>/vertex_index/catalog.json          columns (models) and source signatures
+#   <artifact_root>/vertex_index/<hemi>.<measure>.<kind>.npy
+
+INDEX_NAME = 'vertex_index'
+FORMAT_VERSION = 1
+
+KINDS = {'est': 'float32', 'p': 'float32', 'ocn': 'uint16'}
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _read_catalog(index_dir):
+    try:
+        with open(os.path.join(index_dir, 'catalog.json')) as f:
+            catalog = json.load(f)
+        return catalog if catalog.get('format') == FORMAT_VERSION else {'format': FORMAT_VERSION, 'tables': {}}
+    except FileNotFoundError:
+        return {'format': FORMAT_VERSION, 'tables': {}}
+
+
+def _write_catalog(index_dir, catalog):
+    with open(os.path.join(index_dir, 'catalog.json.tmp'), 'w') as f:
+        json.dump(catalog, f)
+    os.replace(os.path.join(index_dir, 'catalog.json.tmp'), os.path.join(index_dir, 'catalog.json'))
+
+
+def _table_sources(resdir, hemi, measure, columns):
+    return {f'{group}/{model}': {kind: result_map_path(resdir, group, model, measure, hemi, kind) for kind in KINDS}
+            for group, model in columns}
+
+
+def _signature(sources):
+    return {col: {kind: _stamp(path) for kind, path in paths.items()} for col, paths in sources.items()}
+
+
+def write_table(index_dir, resdir, hemi, measure, columns, signature, previous=None):
+    # Columns whose source files did not change since the previous build are copied from the
+    # existing table instead of being read again
+    sources = _table_sources(resdir, hemi, measure, columns)
+
+    reused = {}
+    if previous is not None:
+        old = {f'{g}/{m}': i for i, (g, m) in enumerate(previous['columns'])}
+        reused = {n: old[f'{g}/{m}'] for n, (g, m) in enumerate(columns)
+                  if previous['signature'].get(f'{g}/{m}') == signature[f'{g}/{m}']}
+
+    for kind, dtype in KINDS.items():
+        path = os.path.join(index_dir, f'{hemi}.{measure}.{kind}.npy')
+        if reused and os.path.exists(path):
+            existing = np.load(path, mmap_mode='r')
+            matrix = np.empty((existing.shape[0], len(columns)), dtype=dtype)
+            matrix[:, list(reused)] = existing[:, list(reused.values())]
+            for n, (g, m) in enumerate(columns):
+                if n not in reused:
+                    matrix[:, n] = read_surface_map(sources[f'{g}/{m}'][kind])
+        else:
+            matrix = np.stack([read_surface_map(sources[f'{g}/{m}'][kind]) for g, m in columns], axis=1).astype(dtype)
+
+        tmp = os.path.join(index_dir, f'{hemi}.{measure}.{kind}.tmp.npy')
+        np.save(tmp, matrix)
+        os.replace(tmp, path)
+
+    return {'columns': [list(c) for c in columns], 'signature': signature}
+
+
+@timed('build_vertex_index')
+def ensure_vertex_index(resdir, maps=None, changed=None):
+    # (Re)build the tables whose models changed since the last build, returns the catalog.
+    # maps: (group, model, measure) of the tree (scanned by default), changed: the only (group, model)
+    # that may have changed since the last build (by default, the files of all models are checked)
+    index_dir = artifact_dir(resdir, INDEX_NAME)
+
+    with open(os.path.join(index_dir, 'build.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # e.g. several workers updating after the same change
+        catalog = _read_catalog(index_dir)
+
+        wanted = {}
+        for group, model, measure in (list_result_maps(resdir) if maps is None else maps):
+            for hemi in ['left', 'right']:
+                wanted.setdefault(f'{hemi}.{measure}', []).append((group, model))
+        wanted = {table: sorted(columns) for table, columns in wanted.items()}  # independent of the scan order
+
+        changed_tables = False
+        for table, columns in wanted.items():
+            hemi, measure = table.split('.')
+            current = catalog['tables'].get(table)
+
+            if changed is not None and current is not None:
+                known = current['signature']
+                sources = _table_sources(resdir, hemi, measure,
+                                         [c for c in columns if tuple(c) in changed or f'{c[0]}/{c[1]}' not in known])
+                signature = {f'{g}/{m}': known.get(f'{g}/{m}') for g, m in columns} | _signature(sources)
+            else:
+                signature = _signature(_table_sources(resdir, hemi, measure, columns))
+
+            if current is None or current['signature'] != signature or \
+                    current['columns'] != [list(c) for c in columns]:
+                catalog['tables'][table] = write_table(index_dir, resdir, hemi, measure, columns, signature, current)
+                changed_tables = True
+
+        for table in set(catalog['tables']) - set(wanted):
+            del catalog['tables'][table]
+            changed_tables = True
+
+        if changed_tables:
+            _write_catalog(index_dir, catalog)
+
+    return catalog
+
+# ===== QUERIES ==============================================================================
+
+
+def _open_tables(resdir):
+    # Memory-mapped tables, (re)opened when the catalog changed. The first opening in a process makes
+    # sure that the index is up to date
+    index_dir = artifact_dir(resdir, INDEX_NAME)
+    catalog_path = os.path.join(index_dir, 'catalog.json')
+
+    with _tables_lock:
+        cached = _tables.get(index_dir)
+        if cached is not None and os.path.exists(catalog_path) and cached[0] == os.stat(catalog_path).st_mtime_ns:
+            return cached[1]
+
+    catalog = ensure_vertex_index(resdir) if cached is None else _read_catalog(index_dir)
+    tables = {table: (info['columns'],
+                      {kind: np.load(os.path.join(index_dir, f'{table}.{kind}.npy'), mmap_mode='r') for kind in KINDS})
+              for table, info in catalog['tables'].items()}
+
+    with _tables_lock:
+        _tables[index_dir] = (os.stat(catalog_path).st_mtime_ns, tables)
+
+    return tables
+
+
+def query_vertex(resdir, hemi, vertex, measures=None):
+    # Values of all models at one vertex: list of (group, model, measure, beta, -log10(p), cluster)
+    rows = []
+    for table, (columns, matrices) in _open_tables(resdir).items():
+        table_hemi, measure = table.split('.')
+        if table_hemi != hemi or (measures is not None and measure not in measures):
+            continue
+
+        est, logp, ocn = [matrices[kind][vertex] for kind in KINDS]
+        rows.extend((group, model, measure, float(b), float(p), int(c))
+                    for (group, model), b, p, c in zip(columns, est, logp, ocn))
+    return rows
+
+
+def vertex_table(resdir, hemi, vertex, measures=None):
+    table = pd.DataFrame(query_vertex(resdir, hemi, vertex, measures),
+                         columns=['Phenotype', 'Model', 'Measure', 'Beta', '-log10(p)', 'Cluster'])
+    return table.sort_values('-log10(p)', ascending=False).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    resdir = sys.argv[1] if len(sys.argv) > 1 else './results'
+    print(f'Indexed tables: {", ".join(ensure_vertex_index(resdir)["tables"])}')